@@ -1,5 +1,9 @@
+import concurrent.futures
 import enum
+import itertools
 import json
+import math
+import threading
 
 import image
 import util
@@ -8,17 +12,26 @@ class AssetType(enum.Enum):
     IMAGE = 0
     TOKEN = 1
     WRAPPER = 1
+    TILED_IMAGE = 2
 
 class Asset():
     """A resource which can be used on a battlemap."""
 
+    # source of uids; unlike ids these are unique within the process even
+    # for assets which haven't been saved, or which come from other projects
+    _uids = itertools.count()
+
     def __init__(self, **kwargs):
         """name: the human-readable name associated with the asset."""
         
+        self.uid = next(Asset._uids)
         self.id = kwargs.get('id', None)
         self.path = kwargs.get('path', None)
         self.name = kwargs.get('name', 'untitled')
         self.description = kwargs.get('description', '')
+        # digest, as by util.digest, of the file the asset was loaded from
+        # or else of its blob, which identifies its content across sessions
+        self.digest = kwargs.get('digest', None)
         self.type = kwargs.get('asset_type')
         if self.type is None:
             raise ValueError('Attempted asset creation without asset type.')
@@ -33,6 +46,12 @@ class Asset():
         """A thumbnail representation of this asset."""
         return None
 
+    @property
+    def thumbnail_blob(self):
+        """The thumbnail of this asset encoded as a blob, for storing."""
+        thumbnail = self.thumbnail
+        return None if thumbnail is None else thumbnail.as_bytes()
+
     def get_blob(self):
         return None
 
@@ -71,63 +90,97 @@ class AssetPreview(AssetWrapper):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         thumbnail = kwargs.get('thumbnail', image.Image())
+        # a thumbnail given as a blob is kept as it is, and only decoded if
+        # it is shown
         if type(thumbnail) == bytes:
-            self._thumbnail = image.Image.from_bytes(thumbnail)
+            self._thumbnail = None
+            self._thumbnail_blob = thumbnail
         elif type(thumbnail) == image.Image:
             self._thumbnail = thumbnail
+            self._thumbnail_blob = None
         else:
             raise TypeError('Inappropriate type passed for thumbnail.')
 
     @property
     def thumbnail(self):
+        if self._thumbnail is None:
+            self._thumbnail = image.Image.from_bytes(self._thumbnail_blob)
         return self._thumbnail
 
+    @property
+    def thumbnail_blob(self):
+        if self._thumbnail_blob is None:
+            self._thumbnail_blob = self._thumbnail.as_bytes()
+        return self._thumbnail_blob
+
 class LazyAsset(AssetPreview):
-    """A lazy asset pretends to be an asset and loads it when required."""
-
-    NO_LOAD_ATTRS = [
-        '_asset',
-        '_init_done',
-        '_thumbnail',
-        'asset',
-        'asset_type',
-        'id',
-        'load_asset',
-        'loader',
-        'thumbnail'
-    ]
+    """
+    A lazy asset pretends to be an asset and loads it when required. Once
+    loaded, it becomes the asset, taking on its class and attributes, so
+    that it costs no more to use than the asset would have.
+    """
 
     def __init__(self, **kwargs):
-        self._init_done = False
-
         super().__init__(**kwargs)
+        # the type of the asset rather than of a wrapper, so that it can be
+        # checked without loading the asset
+        self.type = kwargs.get('asset_type')
         self.loader = kwargs.get('loader')
+        self.tile_loader = kwargs.get('tile_loader')
 
         # a lazy asset needs to be able to load its asset by id
         assert self.id is not None
 
-        self._init_done = True
-
-    def __getattribute__(self, name):
-        if not name in LazyAsset.NO_LOAD_ATTRS and self._init_done:
-            self.load_asset()
-            return object.__getattribute__(self._asset, name)
-        return object.__getattribute__(self, name)
-
-    def __setattr__(self, name, value):
-        if not name in LazyAsset.NO_LOAD_ATTRS and self._init_done:
-            self.load_asset()
-            object.__setattr__(self._asset, name, value)
-        object.__setattr__(self, name, value)
+    def __getattr__(self, name):
+        # only called for attributes the lazy asset doesn't have, which
+        # are those of the asset; special names are left alone so that
+        # copying or inspecting a lazy asset doesn't load it
+        if name.startswith('__'):
+            raise AttributeError(name)
+        self.load_asset()
+        return getattr(self, name)
 
     @property
     def asset(self):
         self.load_asset()
-        return self._asset
+        return self
+
+    @property
+    def properties(self):
+        self.load_asset()
+        return self.properties
+
+    def get_blob(self):
+        self.load_asset()
+        return self.get_blob()
+
+    def get_data(self):
+        self.load_asset()
+        return self.get_data()
+
+    def save(self, path):
+        self.load_asset()
+        return self.save(path)
+
+    def get_dict(self):
+        self.load_asset()
+        return self.get_dict()
 
     def load_asset(self):
-        if self._asset is None:
-            self._asset = build_from_db_tup(self.loader(self.id))
+        """
+        load the asset and become it. Its uid is kept, so that anything
+        cached for this lazy asset is still found.
+        """
+
+        asset = build_from_db_tup(
+            self.loader(self.id),
+            tile_loader=self.tile_loader
+        )
+        uid = self.uid
+        self.__dict__.clear()
+        self.__dict__.update(asset.__dict__)
+        self.__class__ = type(asset)
+        self.uid = uid
 
 class AssetLibrary():
     """A collection of assets."""
@@ -180,6 +233,48 @@ class AssetMapping(AssetLibrary):
     def get_by_id(self, asset_id):
         return self.mapping[asset_id]
 
+class ThumbnailCache():
+    """
+    Thumbnails of images, with their blobs, made on a pool of threads so
+    that importing an image doesn't wait on its thumbnail. Each is made
+    once for each digest, however many assets have that digest.
+    """
+
+    WORKERS = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        # maps digests to futures of (thumbnail, blob)
+        self.thumbnails = {}
+
+    def request(self, img, digest=None):
+        """
+        return a future of the (thumbnail, blob) of img, which is started if
+        there is none for digest. Without a digest it is always started.
+        """
+
+        with self.lock:
+            if digest in self.thumbnails:
+                return self.thumbnails[digest]
+
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(
+                    ThumbnailCache.WORKERS,
+                    thread_name_prefix='thumbnail'
+                )
+            future = self.pool.submit(ThumbnailCache.make, img)
+            if digest is not None:
+                self.thumbnails[digest] = future
+            return future
+
+    @staticmethod
+    def make(img):
+        thumbnail = img.as_thumbnail()
+        return thumbnail, thumbnail.as_bytes()
+
+thumbnail_cache = ThumbnailCache()
+
 class ImageAsset(Asset):
     """An image, like a map or a token."""
 
@@ -187,26 +282,77 @@ class ImageAsset(Asset):
         kwargs['asset_type'] = AssetType.IMAGE
         super().__init__(**kwargs)
         self.image = kwargs.get('image', image.Image())
+        self._mipmaps = None
+        # the thumbnail and its blob, once they are made or loaded, or the
+        # future of them while they are being made
+        self._thumbnail = None
+        self._thumbnail_blob = kwargs.get('thumbnail', None)
+        self._thumbnail_future = None
     
     @property
     def size(self):
         return self.image.size
 
+    @property
+    def mipmaps(self):
+        """downscaled copies of this image, built as they are needed"""
+        if self._mipmaps is None:
+            self._mipmaps = image.MipmapPyramid(self.image)
+        return self._mipmaps
+
     @property
     def properties(self):
         return '{' + f'"w": {self.image.w}, "h": {self.image.h}' + '}'
 
     @property
     def thumbnail(self):
-        return self.image.as_thumbnail()
+        self.finish_thumbnail()
+        if self._thumbnail is None:
+            self._thumbnail = image.Image.from_bytes(self._thumbnail_blob)
+        return self._thumbnail
+
+    @property
+    def thumbnail_blob(self):
+        self.finish_thumbnail()
+        return self._thumbnail_blob
+
+    def start_thumbnail(self):
+        """start making the thumbnail in the background, if it isn't made"""
+        if self._thumbnail_blob is None and self._thumbnail_future is None:
+            self._thumbnail_future = thumbnail_cache.request(
+                self.image,
+                self.digest
+            )
+
+    def finish_thumbnail(self):
+        """wait for the thumbnail to be made, starting it if need be"""
+        if self._thumbnail_blob is None:
+            self.start_thumbnail()
+            self._thumbnail, self._thumbnail_blob = \
+                self._thumbnail_future.result()
+            self._thumbnail_future = None
+
+    def downscaled(self, max_size):
+        """the largest of this image's mipmaps which fits in max_size"""
+        max_w, max_h = max_size
+        w, h = self.image.size
+        while w > max_w or h > max_h:
+            w, h = w // 2, h // 2
+        return self.mipmaps.level_for((w, h))
+
+    def read_region(self, rect):
+        """return a region of this image at full size"""
+        return self.image.crop(rect)
 
     def get_blob(self):
         return self.image.as_bytes()
 
     def get_data(self):
-        """blob of this image and hash thereof"""
+        """blob of this image and its digest"""
         blob = self.get_blob()
-        return blob, hash(blob)
+        if self.digest is None:
+            self.digest = util.digest(blob)
+        return blob, self.digest
 
     def save(self, path):
         pass
@@ -216,29 +362,163 @@ class ImageAsset(Asset):
 
     @staticmethod
     def from_file(path):
-        return ImageAsset(
+        asset = ImageAsset(
             path=util.abs_path(path),
             name=util.asset_name_from_path(path),
-            image=image.Image.from_file(path)
+            image=image.Image.from_file(path),
+            digest=util.file_digest(path)
         )
+        asset.start_thumbnail()
+        return asset
+
+class TiledImageAsset(ImageAsset):
+    """
+    A very large image, stored as a pyramid of tiles. Level 0 holds the
+    image at full size and each further level is half the size of the last,
+    up to a level which fits in a single tile. Tiles are only decoded when
+    drawn, and are kept in image.tile_cache. The image attribute holds the
+    top level, which stands in for the whole image where a single image is
+    needed, such as for thumbnails.
+    """
+
+    TILE_SIZE = 1024
+    # images with more pixels than this are tiled when loaded
+    MIN_PIXELS = 4096 * 4096
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.type = AssetType.TILED_IMAGE
+
+        self.w, self.h = kwargs.get('size', self.image.size)
+        self.tile_size = kwargs.get('tile_size', TiledImageAsset.TILE_SIZE)
+        # maps (level, col, row) to encoded tiles held in memory
+        self.tiles = kwargs.get('tiles', {})
+        # function taking (level, col, row) and returning the encoded tile,
+        # for tiles which aren't held in memory
+        self.tile_loader = kwargs.get('tile_loader')
+
+        self.levels = 1
+        while max(self.level_size(self.levels - 1)) > self.tile_size:
+            self.levels += 1
+
+    @property
+    def size(self):
+        return self.w, self.h
+
+    @property
+    def properties(self):
+        return json.dumps({
+            'w': self.w,
+            'h': self.h,
+            'tile_size': self.tile_size
+        })
+
+    def level_size(self, level):
+        factor = 2 ** level
+        return math.ceil(self.w / factor), math.ceil(self.h / factor)
+
+    def level_for(self, size):
+        """return the smallest level at least as large as size"""
+        w, h = size
+        level = 0
+        while level + 1 < self.levels:
+            next_w, next_h = self.level_size(level + 1)
+            if next_w < w or next_h < h:
+                break
+            level += 1
+        return level
+
+    def tile_counts(self, level):
+        """return the number of columns and rows of tiles in level"""
+        w, h = self.level_size(level)
+        return math.ceil(w / self.tile_size), math.ceil(h / self.tile_size)
+
+    def get_tile_blob(self, level, col, row):
+        key = (level, col, row)
+        if key in self.tiles:
+            return self.tiles[key]
+        if self.tile_loader is None:
+            raise ValueError(f'Tile {key} of {self.name} is unavailable.')
+        return self.tile_loader(*key)
+
+    def get_tile(self, level, col, row):
+        """return the decoded image of a tile"""
+        return image.tile_cache.get(
+            (self.uid, level, col, row),
+            lambda: image.Image.from_bytes(
+                self.get_tile_blob(level, col, row)
+            )
+        )
+
+    def read_region(self, rect, level=0):
+        """return a region of a level, assembled from its tiles"""
+        x, y, w, h = rect
+        region = image.Image(size=(w, h))
+        size = self.tile_size
+        for row in range(y // size, math.ceil((y + h) / size)):
+            for col in range(x // size, math.ceil((x + w) / size)):
+                region.paste(
+                    self.get_tile(level, col, row),
+                    (col * size - x, row * size - y)
+                )
+        return region
+
+    def downscaled(self, max_size):
+        """the largest level of this image within max_size"""
+        max_w, max_h = max_size
+        level = 0
+        while level + 1 < self.levels:
+            w, h = self.level_size(level)
+            if w <= max_w and h <= max_h:
+                break
+            level += 1
+        return self.read_region((0, 0, *self.level_size(level)), level)
+
+    def get_tiles(self):
+        """yield (level, col, row, blob) for each tile"""
+        for level in range(self.levels):
+            cols, rows = self.tile_counts(level)
+            for col in range(cols):
+                for row in range(rows):
+                    yield level, col, row, self.get_tile_blob(level, col, row)
+
+    @staticmethod
+    def from_file(path):
+        size, tiles = image.split_into_tiles(path, TiledImageAsset.TILE_SIZE)
+        top = max(level for level, _col, _row in tiles)
+
+        asset = TiledImageAsset(
+            path=util.abs_path(path),
+            name=util.asset_name_from_path(path),
+            image=image.Image.from_bytes(tiles[(top, 0, 0)]),
+            size=size,
+            tiles=tiles,
+            digest=util.file_digest(path)
+        )
+        asset.start_thumbnail()
+        return asset
 
 def load_asset(path):
     if util.get_file_extension(path) in image.Image.FORMATS:
+        w, h = image.read_size(path)
+        if w * h > TiledImageAsset.MIN_PIXELS:
+            return TiledImageAsset.from_file(path)
         return ImageAsset.from_file(path)
 
     raise ValueError(f'Not sure how to open {path}')
 
-def build_from_db_tup(tup, lazy=False, loader=None):
+def build_from_db_tup(tup, lazy=False, loader=None, tile_loader=None):
     """
     Builds an asset from data drawn from the database. If lazy is true, the
-    asset will be a LazyAsset with loader function loader.
+    asset will be a LazyAsset with loader function loader. tile_loader takes
+    (asset_id, level, col, row) and returns a tile of a tiled image.
     """
 
     if lazy:
-        asset_id, name, asset_type, thumbnail = tup
+        asset_id, name, asset_type, thumbnail, digest = tup
     else:
         asset_id, name, asset_type, properties, thumbnail, description, data, \
-            _asset_hash = tup
+            digest = tup
         properties = json.loads(properties)
 
     asset_type = AssetType(asset_type)
@@ -249,7 +529,9 @@ def build_from_db_tup(tup, lazy=False, loader=None):
             name=name,
             asset_type=asset_type,
             thumbnail=thumbnail,
-            loader=loader
+            digest=digest,
+            loader=loader,
+            tile_loader=tile_loader
         )
     elif asset_type == AssetType.IMAGE:
         return ImageAsset(
@@ -259,7 +541,20 @@ def build_from_db_tup(tup, lazy=False, loader=None):
             properties=properties,
             thumbnail=thumbnail,
             description=description,
+            digest=digest,
             image=image.Image.from_bytes(data)
         )
+    elif asset_type == AssetType.TILED_IMAGE:
+        return TiledImageAsset(
+            id=asset_id,
+            name=name,
+            thumbnail=thumbnail,
+            description=description,
+            digest=digest,
+            image=image.Image.from_bytes(data),
+            size=(properties['w'], properties['h']),
+            tile_size=properties['tile_size'],
+            tile_loader=lambda *key: tile_loader(asset_id, *key)
+        )
     
     raise ValueError(f'I couldn\'t build an asset from the data {tup}')
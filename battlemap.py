@@ -1,31 +1,91 @@
+import math
+import threading
+
+import compositor
 import gui_util
+import grid
 import grid_det
 import image
+import input_queue
+import profiling
+import rect
+import scheduler
 import stage
 
 # TODO image flickering problem; more severe with more images
 
 class BattleMap():
     SCROLL_SPEED_COEFF = 0.2
-    SCROLL_DELTA_DEFAULT = 120 
     ZOOM_SPEED_COEFF = 0.001
     ZOOM_MAX = 1.5
     ZOOM_MIN = 0.1
+    # largest pixel stride at which the output can be partially resampled
+    MAX_RESAMPLE_STEP = 64
+    # output pixels around a region which are resampled along with it
+    RESAMPLE_MARGIN = 4
+    # if true, assets and grid are scaled to the output size as they are
+    # drawn, rather than drawing at map scale and scaling the whole frame
+    DIRECT_RENDER = True
 
     def __init__(self, **kwargs):
         self.vp_base_w, self.vp_base_h = kwargs.get('vp_size', (1280, 720))
         self.vp_x, self.vp_y = kwargs.get('vp_pos', (0, 0))
 
         self.stage = kwargs.get('stage', stage.Stage())
+        self.direct_render = kwargs.get(
+            'direct_render',
+            BattleMap.DIRECT_RENDER
+        )
+
+        # decides when the render loop draws a frame
+        self.scheduler = scheduler.FrameScheduler(
+            frame_rate=kwargs.get(
+                'frame_rate',
+                scheduler.FrameScheduler.DEFAULT_FRAME_RATE
+            ),
+            on_demand=kwargs.get('on_demand', True)
+        )
+        self.stage.on_damage = self.request_frame
 
         self.image = None
-        self.grid_image = None
-        self.render_grid()
+        self.grid = grid.GridPainter(
+            colour=kwargs.get('grid_colour', gui_util.Colours.BLACK),
+            style=kwargs.get('grid_style', grid.GridStyle.SOLID)
+        )
         self.redraw = True
         self.redraw_grid = True
+        # grids already found in images, by the digests of the images, as
+        # with an ArchiveDatabase
+        self.grid_cache = kwargs.get('grid_cache', None)
+
+        # frame into which only damaged regions are redrawn; this is the
+        # output image when rendering directly, otherwise it is at vp_size
+        self.compositor = compositor.Compositor(self.make_frame)
+        # cached layer of the background assets and grid, which the tokens
+        # are drawn over to produce the frame
+        self.background = compositor.Compositor(self.make_frame)
+        # viewport position and size when the frame was last composited
+        self.frame_view = None
+        # regions of self.image which changed in the last call to render
+        self.updated = []
+        # whether the view moved in the last call to render, shifting or
+        # replacing all of self.image rather than only the updated regions
+        self.scrolled = False
+        # whether all of self.image must be resampled from the frame
+        self.rescale = True
 
         self.holding = None
         self.holding_drag_point = None
+        # cursor to show for what the mouse last hovered over, or None if it
+        # hasn't changed. The ui thread applies it once lock is released, as
+        # tk calls from the render thread wait on the ui thread.
+        self.cursor = None
+
+        # mouse input from the ui thread, handled once per frame
+        self.input = input_queue.InputQueue(listener=self.request_frame)
+        # held while the map is being updated or rendered, so that other
+        # threads can safely act on it
+        self.lock = threading.RLock()
 
     @property
     def vp_w(self):
@@ -39,117 +99,333 @@ class BattleMap():
     def vp_size(self):
         return self.vp_w, self.vp_h
 
+    @property
+    def output_size(self):
+        return self.vp_base_w, self.vp_base_h
+
+    @property
+    def scale(self):
+        """frame pixels per map pixel"""
+        if self.direct_render:
+            return 1 / self.stage.zoom_level
+        return 1
+
+    @property
+    def frame_size(self):
+        if self.direct_render:
+            return self.output_size
+        return self.vp_size
+
+    @property
+    def frame_origin(self):
+        """
+        position of the frame in map coordinates multiplied by scale. Points
+        are placed relative to this, rather than scaling their offset from the
+        viewport, so that scrolling moves everything by whole pixels.
+        """
+
+        return math.floor(self.vp_x * self.scale), \
+            math.floor(self.vp_y * self.scale)
+
+    @property
+    def grid_extent(self):
+        map_w, map_h = self.stage.map_size
+        return map_w + self.stage.line_width, map_h + self.stage.line_width
+
+    def to_frame_rect(self, region):
+        """convert a region in map coordinates to frame coordinates"""
+        x, y, w, h = region
+        s = self.scale
+        origin_x, origin_y = self.frame_origin
+
+        left = math.floor(x * s)
+        top = math.floor(y * s)
+        return left - origin_x, top - origin_y, \
+            math.floor((x + w) * s) - left, math.floor((y + h) * s) - top
+
+    def to_map_rect(self, region):
+        """the region of the map, rounded outward, shown by region of frame"""
+        x, y, w, h = region
+        s = self.scale
+        origin_x, origin_y = self.frame_origin
+
+        left = math.floor((x + origin_x) / s)
+        top = math.floor((y + origin_y) / s)
+        return left, top, math.ceil((x + w + origin_x) / s) - left, \
+            math.ceil((y + h + origin_y) / s) - top
+
     def new_frame(self):
-        return self.redraw or self.redraw_grid
+        return self.redraw or self.redraw_grid or self.stage.damaged or \
+            self.input.pending
+
+    def process_input(self):
+        """handle the input queued since the last frame"""
+
+        handlers = {
+            input_queue.InputKind.MOTION: self.handle_mouse_motion,
+            input_queue.InputKind.SCROLL: self.handle_mouse_scroll,
+            input_queue.InputKind.BUTTON_DOWN: self.handle_mouse_down,
+            input_queue.InputKind.BUTTON_UP: self.handle_mouse_up
+        }
+
+        with self.lock:
+            for event in self.input.drain():
+                handlers[event.kind](event)
+
+    def request_frame(self):
+        self.scheduler.request_frame()
 
     def set_vp_size(self, new_size):
         self.vp_base_w, self.vp_base_h = new_size
         self.redraw = self.redraw_grid = True
+        self.request_frame()
 
     def set_stage(self, new):
         self.stage = new
+        self.stage.on_damage = self.request_frame
+        self.stage.pop_damage()
+        self.background.invalidate()
+        self.compositor.invalidate()
         self.redraw = self.redraw_grid = True
+        self.request_frame()
 
-    def get_photo_image(self):
-        return self.image.get_imagetk()
+    def make_frame(self, size):
+        return image.Image(size=size, bg_colour=self.stage.bg_colour)
 
     def snap_to_grid(self, map_image):
-        img = map_image.base_image
-        row, col = grid_det.calc_grid_size(img.as_greyscale_array())
-        
+        """
+        scale map_image so that the grid drawn on it matches the size of the
+        stage's grid. If its grid is found confidently, it is also moved so
+        that its lines lie on the stage's.
+        """
+
+        asset = map_image.asset
+        w, h = asset.size
+        tile = self.stage.total_tile_size
+
+        grid = None
+        if self.grid_cache is not None and asset.digest is not None:
+            grid = self.grid_cache.load_grid(asset.digest)
+        if grid is None:
+            grid = grid_det.analyse_asset(asset)
+            if self.grid_cache is not None and asset.digest is not None:
+                self.grid_cache.add_grid(asset.digest, grid)
+        if grid['error'] is not None:
+            raise ValueError(grid['error'])
+
+        spacing_x, spacing_y = grid['spacing']
         map_image.set_size(
-            int(map_image.w * (self.stage.tile_size / row)),
-            int(map_image.h * (self.stage.tile_size / col))
+            round(w * tile / spacing_x),
+            round(h * tile / spacing_y)
         )
         self.redraw = True
+        if grid['offset'] is None:
+            return
+
+        offset_x, offset_y = grid['offset']
+        flip_x, flip_y = map_image.flips
+        if flip_x:
+            offset_x = w - offset_x
+        if flip_y:
+            offset_y = h - offset_y
+
+        # move the image by the least amount that puts a line's centre on
+        # the centre of a line of the stage's grid
+        line_centre = self.stage.line_width / 2
+        line_x = map_image.x + offset_x * map_image.w / w
+        line_y = map_image.y + offset_y * map_image.h / h
+        map_image.set_pos(
+            round(map_image.x + (line_centre - line_x + tile / 2) % tile \
+                - tile / 2),
+            round(map_image.y + (line_centre - line_y + tile / 2) % tile \
+                - tile / 2)
+        )
 
-    def render_grid(self):
-        max_right = self.stage.total_tile_size * self.stage.width
-        max_bottom = self.stage.total_tile_size * self.stage.height
-
-        right = min(self.vp_w + self.stage.tile_size, max_right) \
-            + self.stage.line_width
-        bottom = min(self.vp_h + self.stage.tile_size, max_bottom) \
-            + self.stage.line_width
+    def update_view(self):
+        """
+        move the frame to the current viewport, scrolling its contents where
+        possible and damaging it entirely where not.
+        """
+
+        origin_x, origin_y = self.frame_origin
+        view = (origin_x, origin_y, self.frame_size, self.scale)
+        self.scrolled = view != self.frame_view
+        if self.frame_view is not None and self.frame_view[2:] == view[2:]:
+            old_x, old_y, *_ = self.frame_view
+            if (old_x, old_y) != (origin_x, origin_y):
+                dx, dy = old_x - origin_x, old_y - origin_y
+                self.background.scroll(dx, dy)
+                self.compositor.scroll(dx, dy)
+                # the output can't be scrolled by a fractional amount
+                self.rescale = True
+        else:
+            self.background.invalidate()
+            self.compositor.invalidate()
+        self.frame_view = view
+
+        for region, background in self.stage.pop_damage():
+            if region is None:
+                frame_region = None
+            else:
+                frame_region = rect.inflate(self.to_frame_rect(region), 1)
+
+            if background:
+                self.background.invalidate(frame_region)
+            self.compositor.invalidate(frame_region)
+
+    def draw_assets(self, frame, region, background):
+        """draw the assets of a layer which overlap region of frame"""
+        for i in self.stage.assets_in(self.to_map_rect(region)):
+            if i.BACKGROUND != background:
+                continue
+
+            dest_x, dest_y, dest_w, dest_h = self.to_frame_rect(i.bounds)
+            clip = rect.intersect((dest_x, dest_y, dest_w, dest_h), region)
+            if clip is not None:
+                cx, cy, cw, ch = clip
+                i.render_to(
+                    frame,
+                    cx,
+                    cy,
+                    (cx - dest_x, cy - dest_y, cw, ch),
+                    (dest_w, dest_h)
+                )
 
-        grid = image.Image(
-            size=(right, bottom),
-            bg_colour=gui_util.Colours.CLEAR
+    def draw_background_region(self, layer, region):
+        """redraw region of the background layer"""
+        profiler = profiling.profiler
+
+        with profiler.phase('blit'):
+            layer.fill(self.stage.bg_colour, region)
+            self.draw_assets(layer, region, True)
+
+        with profiler.phase('grid'):
+            self.draw_grid_region(layer, region)
+
+    def draw_region(self, frame, region):
+        """redraw region of frame from the background layer and tokens"""
+        with profiling.profiler.phase('blit'):
+            frame.paste(self.background.frame.crop(region), region[:2])
+            self.draw_assets(frame, region, False)
+
+    def draw_grid_region(self, frame, region):
+        """draw the grid lines crossing region of frame, at frame scale"""
+        s = self.scale
+        self.grid.draw(
+            frame,
+            region,
+            self.to_frame_rect((0, 0, *self.grid_extent)),
+            self.stage.total_tile_size,
+            s,
+            max(round(self.stage.line_width * s), 1),
+            (self.stage.width, self.stage.height)
         )
 
-        for i in range(0, bottom // self.stage.tile_size + 2):
-            y = i * self.stage.total_tile_size + self.stage.line_width // 2
-            grid.draw_line(
-                (0, y),
-                (right, y),
-                gui_util.Colours.BLACK,
-                self.stage.line_width
+    def scale_regions(self, frame, regions):
+        """
+        resample regions of frame into the output image, returning the
+        regions of the output image which were updated.
+        """
+
+        out_w, out_h = self.output_size
+        if frame.size == self.output_size:
+            self.image = frame
+            return regions
+
+        # a region can only be resampled on its own if it starts on a pixel
+        # which lines up exactly in both the frame and the output, otherwise
+        # it will be filtered slightly differently to its surroundings. The
+        # same goes for enlarging, where filters don't map pixels linearly.
+        step_x = out_w // math.gcd(out_w, frame.w)
+        step_y = out_h // math.gcd(out_h, frame.h)
+
+        if self.rescale or self.image is None or self.image is frame or \
+            self.image.size != self.output_size or \
+            regions == [self.compositor.bounds] or \
+            frame.w < out_w or frame.h < out_h or \
+            max(step_x, step_y) > BattleMap.MAX_RESAMPLE_STEP:
+
+            self.rescale = False
+            self.image = frame.resize(self.output_size)
+            return [(0, 0, out_w, out_h)]
+
+        scale_x = frame.w / out_w
+        scale_y = frame.h / out_h
+
+        # filters sample pixels around the edge of the region too, so resample
+        # an aligned margin around it and then discard that margin
+        margin_x = step_x * math.ceil(BattleMap.RESAMPLE_MARGIN / step_x)
+        margin_y = step_y * math.ceil(BattleMap.RESAMPLE_MARGIN / step_y)
+
+        updated = []
+        for r in regions:
+            x, y, w, h = rect.inflate(r, math.ceil(scale_x))
+            out_x = max(math.floor(x / scale_x / step_x) * step_x, 0)
+            out_y = max(math.floor(y / scale_y / step_y) * step_y, 0)
+            out_r = min(math.ceil((x + w) / scale_x / step_x) * step_x, out_w)
+            out_b = min(math.ceil((y + h) / scale_y / step_y) * step_y, out_h)
+
+            pad_x = max(out_x - margin_x, 0)
+            pad_y = max(out_y - margin_y, 0)
+            pad_r = min(out_r + margin_x, out_w)
+            pad_b = min(out_b + margin_y, out_h)
+
+            src_x = pad_x * frame.w // out_w
+            src_y = pad_y * frame.h // out_h
+            src_r = pad_r * frame.w // out_w
+            src_b = pad_b * frame.h // out_h
+
+            resampled = frame.crop(
+                (src_x, src_y, src_r - src_x, src_b - src_y)
+            ).resize((pad_r - pad_x, pad_b - pad_y))
+
+            out_rect = (out_x, out_y, out_r - out_x, out_b - out_y)
+            self.image.paste(
+                resampled.crop(rect.offset(out_rect, -pad_x, -pad_y)),
+                (out_x, out_y)
             )
+            updated.append(out_rect)
 
-        for i in range(0, right // self.stage.tile_size + 1):
-            x = i * self.stage.total_tile_size + self.stage.line_width // 2
-            grid.draw_line(
-                (x, 0),
-                (x, bottom),
-                gui_util.Colours.BLACK,
-                self.stage.line_width
-            )
-
-        self.grid_image = grid
+        return updated
 
     def render(self):
-        vp = image.Image(
-            size=self.vp_size,
-            bg_colour=self.stage.bg_colour
-        )
-
         if self.redraw_grid:
-            self.render_grid()
-
-        cropped_x = self.grid_image.w > vp.w
-        cropped_y = self.grid_image.h > vp.h
-
-        self.vp_x = self.vp_x if cropped_x else \
-            -(vp.w - self.grid_image.w) // 2
-        self.vp_y = self.vp_y if cropped_y else \
-            -(vp.h - self.grid_image.h) // 2
-
-        for i in self.stage:
-            x, y = i.x - self.vp_x, i.y - self.vp_y
-            on_screen_x = 0 < x + i.w and x < self.vp_w
-            on_screen_y = 0 < y + i.h and y < self.vp_h 
-            if on_screen_x and on_screen_y:
-                i.render_to(vp, x, y)
-
-        map_w, map_h = self.stage.map_size
-
-        if map_w < self.vp_w:
-            x = (vp.w - self.grid_image.w) // 2
-        # elif map_w < self.vp_x + self.vp_w:
-        #     x =  map_w - self.vp_x - self.vp_w
-        else:
-            x = -(self.vp_x % self.stage.total_tile_size)
-
-        if map_h < self.vp_h:
-            y = (vp.h - self.grid_image.h) // 2
-        # this doesn't quite have the correct offset
-        # elif map_h < self.vp_y + self.vp_h:
-        #     y = map_h - self.vp_y - self.vp_h
+            self.background.invalidate()
+
+        self.background.resize(self.frame_size)
+        self.compositor.resize(self.frame_size)
+        vp_w, vp_h = self.vp_size
+        grid_w, grid_h = self.grid_extent
+
+        cropped_x = grid_w > vp_w
+        cropped_y = grid_h > vp_h
+
+        self.vp_x = self.vp_x if cropped_x else -(vp_w - grid_w) // 2
+        self.vp_y = self.vp_y if cropped_y else -(vp_h - grid_h) // 2
+
+        self.update_view()
+        for r in self.background.compose(self.draw_background_region):
+            self.compositor.invalidate(r)
+        regions = self.compositor.compose(self.draw_region)
+        if self.direct_render:
+            self.image = self.compositor.frame
+            self.updated = regions
         else:
-            y = -(self.vp_y % self.stage.total_tile_size)
+            with profiling.profiler.phase('resize'):
+                self.updated = self.scale_regions(
+                    self.compositor.frame,
+                    regions
+                )
 
-        vp.blit(self.grid_image, (x, y))
+        # the compositors only report the strips a scroll uncovered, but the
+        # rest of the image has shifted too
+        if self.scrolled:
+            self.updated = [(0, 0, *self.image.size)]
 
-        self.image = vp.resize((self.vp_base_w, self.vp_base_h))
         self.redraw = self.redraw_grid = False
 
     def get_hover_state(self, x, y):
-        result = gui_util.DragPoints.NONE, None
-        for i in self.stage:
-            drag_point = i.touching(x, y)
-            if drag_point != gui_util.DragPoints.NONE:
-                result = (drag_point, i)
-        return result
+        return self.stage.asset_at(x, y)
 
     def get_map_coords(self, e_x, e_y):
         return int(e_x * self.stage.zoom_level) + self.vp_x, \
@@ -160,11 +436,10 @@ class BattleMap():
         if self.holding == None:
             point, _ = self.get_hover_state(x, y)
             if point in gui_util.dragpoint_cursor_mapping:
-                gui_util.set_cursor(gui_util.dragpoint_cursor_mapping[point])
+                self.cursor = gui_util.dragpoint_cursor_mapping[point]
             elif type(point) == tuple:
-                gui_util.set_cursor(
+                self.cursor = \
                     gui_util.dragpoint_cursor_mapping[gui_util.DragPoints.BODY]
-                )
         else:
             try:
                 self.holding.handle_resize(self.holding_drag_point, x, y)
@@ -189,22 +464,15 @@ class BattleMap():
         )
 
     def handle_mouse_scroll(self, event):
-        if event.num != '??':
-            delta = -BattleMap.SCROLL_DELTA_DEFAULT if event.num == 4 else \
-                BattleMap.SCROLL_DELTA_DEFAULT
-        else:
-            delta = -event.delta
-
-        zoom = gui_util.get_ctrl_down()
-        x = gui_util.get_shift_down()
-        if zoom:
+        delta = event.delta
+        if event.ctrl:
             self.stage.zoom_level += BattleMap.ZOOM_SPEED_COEFF * delta
             self.stage.zoom_level = max(
                 min(self.stage.zoom_level, BattleMap.ZOOM_MAX),
                 BattleMap.ZOOM_MIN
             )
-            self.render_grid()
-        elif x:
+            self.redraw_grid = True
+        elif event.shift:
             self.vp_x += int(BattleMap.SCROLL_SPEED_COEFF * delta)
         else:
             self.vp_y += int(BattleMap.SCROLL_SPEED_COEFF * delta)
@@ -228,8 +496,6 @@ class BattleMap():
                 *self.get_map_coords(event.x, event.y)
             )
             return img
-        elif event.num in [4, 5]: # Mwheel
-            self.handle_mouse_scroll(event)
 
     def handle_mouse_up(self, event):
         if event.num == 1:
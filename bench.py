@@ -0,0 +1,333 @@
+"""
+Headless benchmarks for battlemap rendering. Each configuration builds a
+synthetic stage and times the main rendering and interaction paths, then the
+results are written to a json file so that runs on different commits can be
+compared.
+
+    python bench.py --out bench_results.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+# must be set before pygame is imported so that no window is needed
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import PIL.Image
+
+import assets
+import battlemap
+import gui_util
+import image
+import profiling
+import stage
+
+RENDERERS = image.RENDERERS
+MODES = ['direct', 'resize']
+TOKEN_COUNTS = [10, 100, 500]
+MAP_SIZES = [1024, 4096]
+ZOOM_LEVELS = [0.5, 1, 1.5]
+
+VP_SIZE = (1280, 720)
+TOKEN_SIZE = 256
+# distinct token images; the rest of the tokens share these
+TOKEN_VARIETY = 8
+SCROLL_STEP = 24
+# reads of each attribute timed by bench_lazy_asset
+LAZY_ASSET_READS = 200000
+
+def synthetic_image(w, h, rng):
+    """return a noisy Image of size w, h using the active renderer"""
+    pixels = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    blob = io.BytesIO()
+    PIL.Image.fromarray(pixels).save(blob, format='BMP')
+    return image.Image.from_bytes(blob.getvalue())
+
+def synthetic_stage(token_count, map_size, zoom, seed=0):
+    rng = np.random.default_rng(seed)
+    rand = random.Random(seed)
+
+    tiles = map_size // (stage.Stage.DEFAULT_TILE_SIZE + \
+        stage.Stage.DEFAULT_LINE_WIDTH)
+    s = stage.Stage(width=tiles, height=tiles, zoom_level=zoom)
+
+    s.add(stage.StageAsset(assets.ImageAsset(
+        name='map',
+        image=synthetic_image(map_size, map_size, rng)
+    )))
+
+    token_assets = [
+        assets.ImageAsset(
+            name=f'token{i}',
+            image=synthetic_image(TOKEN_SIZE, TOKEN_SIZE, rng)
+        ) for i in range(TOKEN_VARIETY)
+    ]
+    for i in range(token_count):
+        token = stage.TokenAsset(
+            token_assets[i % TOKEN_VARIETY],
+            x=rand.randrange(0, map_size),
+            y=rand.randrange(0, map_size)
+        )
+        s.add(token)
+
+    return s
+
+class Timer():
+    def __init__(self):
+        self.phases = {}
+
+    def time(self, phase, func, iterations, frame=False):
+        """time func(i) for i in range(iterations), each a frame if frame"""
+        profiler = profiling.profiler if frame else profiling.NullProfiler()
+
+        start = time.perf_counter()
+        for i in range(iterations):
+            profiler.start_frame()
+            func(i)
+            profiler.end_frame()
+        elapsed = time.perf_counter() - start
+
+        self.phases[phase] = {
+            'iterations': iterations,
+            'total_s': elapsed,
+            'mean_ms': elapsed / iterations * 1e3,
+            'per_s': iterations / elapsed if elapsed else None
+        }
+
+def bench_config(renderer, mode, token_count, map_size, zoom, frames,
+    profile=False):
+
+    image.set_renderer(renderer)
+    image.transform_cache.clear()
+
+    s = synthetic_stage(token_count, map_size, zoom)
+    bm = battlemap.BattleMap(
+        stage=s,
+        vp_size=VP_SIZE,
+        direct_render=(mode == 'direct')
+    )
+    map_w, map_h = s.map_size
+    bm.vp_x = (map_w - bm.vp_w) // 2
+    bm.vp_y = (map_h - bm.vp_h) // 2
+    bm.constrain_viewport()
+    bm.render()
+
+    rand = random.Random(1)
+    timer = Timer()
+    if profile:
+        profiling.enable()
+
+    def full_frame(_i):
+        bm.background.invalidate()
+        bm.compositor.invalidate()
+        bm.render()
+    timer.time('render_full', full_frame, frames, True)
+
+    # drag a token which is on screen, so that there is something to redraw
+    visible = s.assets_in((bm.vp_x, bm.vp_y, *bm.vp_size))
+    tokens = [a for a in visible if type(a) == stage.TokenAsset]
+    held = tokens[-1] if tokens else s.assets[0]
+    def drag_frame(i):
+        drag_x, drag_y = held.w // 2, held.h // 2
+        held.handle_resize(
+            (drag_x, drag_y),
+            held.x + drag_x + (4 if i % 2 else -4),
+            held.y + drag_y + 3
+        )
+        bm.render()
+    timer.time('render_drag', drag_frame, frames, True)
+    held.end_resize()
+
+    def resize_frame(i):
+        held.handle_resize(
+            gui_util.DragPoints.BOTRIGHT,
+            held.x + held.w + (4 if i % 2 else -4),
+            held.y + held.h + 3
+        )
+        bm.render()
+    timer.time('render_resize', resize_frame, frames, True)
+    held.end_resize()
+
+    def scroll_frame(i):
+        bm.vp_y += SCROLL_STEP if (i // 10) % 2 else -SCROLL_STEP
+        bm.vp_x += SCROLL_STEP if (i // 15) % 2 else -SCROLL_STEP
+        bm.constrain_viewport()
+        bm.render()
+    timer.time('render_scroll', scroll_frame, frames, True)
+
+    def grid(_i):
+        frame = bm.background.frame
+        bm.draw_grid_region(frame, (0, 0, *frame.size))
+    timer.time('render_grid', grid, frames)
+
+    points = [
+        (rand.randrange(0, map_w), rand.randrange(0, map_h))
+        for _ in range(frames * 10)
+    ]
+    timer.time(
+        'get_hover_state',
+        lambda i: bm.get_hover_state(*points[i]),
+        len(points)
+    )
+
+    background = s.assets[0]
+    def resize(i):
+        background.handle_resize(
+            gui_util.DragPoints.BOTRIGHT,
+            background.x + background.w - 1 - (i % 7) * 3,
+            background.y + background.h - 1 - (i % 5) * 3
+        )
+    timer.time('handle_resize', resize, frames)
+    background.end_resize()
+
+    result = {
+        'renderer': renderer,
+        'mode': mode,
+        'tokens': token_count,
+        'map_size': map_size,
+        'zoom': zoom,
+        'phases': timer.phases,
+        'transform_cache': image.transform_cache.stats()
+    }
+
+    if profile:
+        result['frame_phases'] = profiling.profiler.summary()['phases']
+        profiling.disable()
+
+    return result
+
+def bench_lazy_asset(reads=LAZY_ASSET_READS):
+    """
+    time reading attributes of a LazyAsset, once loaded, as stage assets do
+    every frame, against reading them from a plain ImageAsset
+    """
+
+    plain = assets.ImageAsset(
+        id=1,
+        name='asset',
+        image=synthetic_image(64, 64, np.random.default_rng(0))
+    )
+    blob, digest = plain.get_data()
+    thumbnail = plain.thumbnail_blob
+    tup = (1, 'asset', assets.AssetType.IMAGE.value, plain.properties,
+        thumbnail, '', blob, digest)
+    lazy = assets.build_from_db_tup(
+        (1, 'asset', assets.AssetType.IMAGE.value, thumbnail, digest),
+        lazy=True,
+        loader=lambda _asset_id: tup
+    )
+    lazy.image
+
+    result = {}
+    for name, asset in (('plain', plain), ('lazy', lazy)):
+        for attr in ('image', 'size', 'uid'):
+            start = time.perf_counter()
+            for _ in range(reads):
+                getattr(asset, attr)
+            elapsed = time.perf_counter() - start
+            result[f'{name}_{attr}_ns'] = elapsed / reads * 1e9
+
+    for attr in ('image', 'size', 'uid'):
+        result[f'{attr}_overhead'] = \
+            result[f'lazy_{attr}_ns'] / result[f'plain_{attr}_ns']
+    return result
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_environment():
+    env = {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__
+    }
+
+    try:
+        image.set_renderer('pygame')
+        env['pygame'] = image.pygame.version.ver
+    except ImportError:
+        env['pygame'] = None
+
+    return env
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--renderers', nargs='+', default=RENDERERS)
+    parser.add_argument('--modes', nargs='+', default=MODES)
+    parser.add_argument('--tokens', nargs='+', type=int, default=TOKEN_COUNTS)
+    parser.add_argument('--map-sizes', nargs='+', type=int, default=MAP_SIZES)
+    parser.add_argument('--zooms', nargs='+', type=float, default=ZOOM_LEVELS)
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='also record per-phase timings within each frame'
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = {
+        'commit': get_commit(),
+        'time': time.time(),
+        'environment': get_environment(),
+        'configs': []
+    }
+
+    for renderer in args.renderers:
+        for mode in args.modes:
+            for token_count in args.tokens:
+                for map_size in args.map_sizes:
+                    for zoom in args.zooms:
+                        result = bench_config(
+                            renderer,
+                            mode,
+                            token_count,
+                            map_size,
+                            zoom,
+                            args.frames,
+                            args.profile
+                        )
+                        results['configs'].append(result)
+
+                        phases = result['phases']
+                        print(
+                            f'{renderer:7} {mode:7} tokens={token_count:<4} '
+                            f'map={map_size:<5} zoom={zoom:<4} ' + ' '.join(
+                                f'{p}={phases[p]["mean_ms"]:.2f}ms'
+                                for p in phases
+                            )
+                        )
+
+    results['lazy_asset'] = bench_lazy_asset()
+    print('lazy asset ' + ' '.join(
+        f'{attr}={results["lazy_asset"][f"lazy_{attr}_ns"]:.0f}ns/'
+        f'{results["lazy_asset"][f"plain_{attr}_ns"]:.0f}ns'
+        for attr in ('image', 'size', 'uid')
+    ))
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
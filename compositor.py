@@ -0,0 +1,106 @@
+import rect
+
+class Compositor():
+    """
+    Keeps a persistent frame buffer along with a list of the regions of it
+    which are out of date, so that each frame only the damaged regions need to
+    be redrawn.
+    """
+
+    # damaged regions are merged down to at most this many before redrawing
+    MAX_REGIONS = 8
+    # if more than this fraction of the frame is damaged, redraw all of it
+    FULL_REDRAW_RATIO = 0.6
+
+    def __init__(self, make_frame):
+        """make_frame: function taking a size and returning a blank image."""
+
+        self.make_frame = make_frame
+        self.frame = None
+        self.damage = []
+        self.full = True
+
+    @property
+    def size(self):
+        if self.frame is None:
+            return 0, 0
+        return self.frame.size
+
+    @property
+    def bounds(self):
+        return (0, 0, *self.size)
+
+    @property
+    def damaged(self):
+        return self.full or bool(self.damage)
+
+    def resize(self, size):
+        """ensure the frame buffer is of size, discarding it if not"""
+        if self.frame is None or self.frame.size != size:
+            self.frame = self.make_frame(size)
+            self.invalidate()
+
+    def invalidate(self, region=None):
+        """mark region (x, y, w, h) of the frame as damaged; None for all"""
+        if region is None:
+            self.full = True
+            self.damage = []
+        elif not self.full:
+            self.damage.append(region)
+
+    def scroll(self, dx, dy):
+        """
+        shift the frame contents by dx, dy, damaging only the strips of the
+        frame which are uncovered by the shift.
+        """
+
+        w, h = self.size
+        if self.full or abs(dx) >= w or abs(dy) >= h:
+            self.invalidate()
+            return
+
+        self.frame.scroll(dx, dy)
+        self.damage = [rect.offset(r, dx, dy) for r in self.damage]
+
+        if dx > 0:
+            self.invalidate((0, 0, dx, h))
+        elif dx < 0:
+            self.invalidate((w + dx, 0, -dx, h))
+
+        if dy > 0:
+            self.invalidate((0, 0, w, dy))
+        elif dy < 0:
+            self.invalidate((0, h + dy, w, -dy))
+
+    def pending(self):
+        """return the list of regions which would be redrawn by compose"""
+        bounds = self.bounds
+        if self.full:
+            return [bounds]
+
+        regions = []
+        for r in self.damage:
+            clipped = rect.intersect(r, bounds)
+            if clipped is not None:
+                regions.append(clipped)
+        regions = rect.merge(regions, Compositor.MAX_REGIONS)
+
+        total = sum(rect.area(r) for r in regions)
+        if total > rect.area(bounds) * Compositor.FULL_REDRAW_RATIO:
+            return [bounds]
+        return regions
+
+    def compose(self, draw):
+        """
+        call draw(frame, region) for each damaged region of the frame, then
+        mark the frame as clean. Returns the list of regions redrawn.
+        """
+
+        regions = self.pending()
+        for r in regions:
+            draw(self.frame, r)
+
+        self.damage = []
+        self.full = False
+
+        return regions
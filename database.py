@@ -1,4 +1,8 @@
 import sqlite3
+import threading
+
+import assets
+import util
 
 # Plan is: use sqlite databases as project file format.
 # Also have a second database for the archive.
@@ -59,14 +63,17 @@ class Database():
     def __init__(self, file):
         self.file = file
         self.conn = None
+        # the connection may be shared with the render thread, which loads
+        # assets as they are needed
+        self.lock = threading.RLock()
         self.tables = {}
         self.startup_commands = [
-            f'PRAGMA user_version = {Database.VERSION};',
+            f'PRAGMA user_version = {self.VERSION};',
             'PRAGMA foreign_keys = ON;'
         ]
 
     def init(self):
-        self.conn = sqlite3.connect(self.file)
+        self.conn = sqlite3.connect(self.file, check_same_thread=False)
         self.migrate()
 
         for t in self.tables:
@@ -77,18 +84,35 @@ class Database():
         return self # useful for chaining
 
     def migrate(self):
+        """bring a database written by an older version up to date"""
         from_version = self.fetch_single('PRAGMA user_version;')
-        if from_version != self.VERSION:
+        if from_version > self.VERSION:
             raise ValueError('Wrong database version!')
 
+        for version in range(from_version, self.VERSION):
+            self.upgrade(version)
+        self.commit()
+
+    def upgrade(self, from_version):
+        """migrate the tables from from_version to the next version"""
+
+    def has_table(self, name):
+        return self.fetch_one(
+            'SELECT name FROM sqlite_master WHERE type = \'table\' '
+            'AND name = ?;',
+            (name,)
+        ) is not None
+
     def execute(self, command, tup=None):
-        if tup is None:
-            self.conn.execute(command)
-        else:
-            self.conn.execute(command, tup)
+        with self.lock:
+            if tup is None:
+                self.conn.execute(command)
+            else:
+                self.conn.execute(command, tup)
 
     def execute_many(self, command, tups):
-        self.conn.executemany(command, tups)
+        with self.lock:
+            self.conn.executemany(command, tups)
 
     def execute_cursor(self, command, tup=None):
         curs = self.conn.cursor()
@@ -100,17 +124,20 @@ class Database():
         return curs
 
     def fetch_one(self, command, tup=None):        
-        return self.execute_cursor(command, tup).fetchone()
+        with self.lock:
+            return self.execute_cursor(command, tup).fetchone()
 
     def fetch_all(self, command, tup=None):
-        return self.execute_cursor(command, tup).fetchall()
+        with self.lock:
+            return self.execute_cursor(command, tup).fetchall()
 
     def fetch_single(self, command, tup=None):
         ret, = self.fetch_one(command, tup)
         return ret
 
     def commit(self):
-        self.conn.commit()
+        with self.lock:
+            self.conn.commit()
 
     def close(self):
         self.conn.close()
@@ -121,7 +148,9 @@ class ProjectDatabase(Database):
     similar assets as blobs for portability.
     """
 
-    VERSION = 0
+    # 1: the hash column holds util.digest of the asset rather than hash,
+    # which is salted differently in each process
+    VERSION = 1
 
     def __init__(self, file):
         super().__init__(file)
@@ -138,6 +167,16 @@ class ProjectDatabase(Database):
             ('data', 'BLOB'),
             ('hash', 'INTEGER')
         ])
+        self.tables['asset_tiles'] = Table('asset_tiles', [
+            ('asset', 'INTEGER'),
+            ('level', 'INTEGER'),
+            ('col', 'INTEGER'),
+            ('row', 'INTEGER'),
+            ('data', 'BLOB')
+        ], constraints=[
+            'PRIMARY KEY(asset, level, col, row)',
+            'FOREIGN KEY(asset) REFERENCES assets(id)'
+        ])
         self.tables['stages'] = Table('stages', [
             ('id', 'INTEGER PRIMARY KEY'),
             ('name', 'TEXT'),
@@ -168,6 +207,23 @@ class ProjectDatabase(Database):
             ('value', 'TEXT')
         ])
 
+    def upgrade(self, from_version):
+        if from_version == 0 and self.has_table('assets'):
+            # the file an asset was imported from isn't kept, so the digest
+            # is of its blob, as for assets with no file. Blobs are read one
+            # at a time as they may be large.
+            for asset_id, in self.fetch_all(
+                'SELECT id FROM assets WHERE data IS NOT NULL;'
+            ):
+                blob = self.fetch_single(
+                    'SELECT data FROM assets WHERE id = ?;',
+                    (asset_id,)
+                )
+                self.execute(
+                    'UPDATE assets SET hash = ? WHERE id = ?;',
+                    (util.digest(blob), asset_id)
+                )
+
     def db_tup_from_asset(self, asset):
         blob, blob_hash = asset.get_data()
         return (
@@ -175,7 +231,7 @@ class ProjectDatabase(Database):
             asset.name,
             asset.type.value,
             asset.properties,
-            asset.thumbnail.as_bytes(),
+            asset.thumbnail_blob,
             asset.description,
             blob,
             blob_hash
@@ -193,16 +249,62 @@ class ProjectDatabase(Database):
             asset.id = self.fetch_single(
                 'SELECT last_insert_rowid() FROM assets;'
             ) 
+
+        self.add_asset_tiles(asset)
     
-    def add_assets(self, assets):
-        """Add assets to the db, setting their ids if unset."""
+    def add_assets(self, asset_list):
+        """
+        Add assets to the db, setting their ids if unset. The blobs and tiles
+        of assets whose digest is the one stored for their id aren't written
+        again, and new assets with the same digest as one already stored
+        share its row.
+        """
+
+        stored = {}
+        ids = {}
+        for asset_id, digest in self.fetch_all('SELECT id, hash FROM assets;'):
+            stored[asset_id] = digest
+            ids.setdefault(digest, asset_id)
+
+        unchanged = {}
+        for a in asset_list:
+            if a.id is None and a.digest is not None and a.digest in ids:
+                a.id = ids[a.digest]
+            elif a.id is not None and a.digest is not None and \
+                stored.get(a.id) == a.digest:
+
+                # assets which were never loaded can't have been changed.
+                # Where assets share a row, it keeps the first one's name.
+                if not isinstance(a, assets.LazyAsset) and \
+                    a.id not in unchanged:
+
+                    unchanged[a.id] = (a.name, a.description, a.id)
+            else:
+                self.add_asset(a)
+                ids.setdefault(a.digest, a.id)
 
         self.execute_many(
-            self.tables['assets'].command('REPLACE'),
-            [self.db_tup_from_asset(a) for a in assets if a.id is not None]
+            'UPDATE assets SET name = ?, description = ? WHERE id = ?;',
+            list(unchanged.values())
+        )
+
+    def add_asset_tiles(self, asset):
+        """store the tiles of asset, if it is tiled"""
+
+        if asset.type != assets.AssetType.TILED_IMAGE:
+            return
+
+        self.execute_many(
+            self.tables['asset_tiles'].command('REPLACE'),
+            [(asset.id, *tile) for tile in asset.get_tiles()]
+        )
+
+    def load_asset_tile(self, asset_id, level, col, row):
+        return self.fetch_single(
+            'SELECT data FROM asset_tiles WHERE asset = ? AND level = ? '
+            'AND col = ? AND row = ?;',
+            (asset_id, level, col, row)
         )
-        for a in [a for a in assets if a.id is None]:
-            self.add_asset(a)
 
     def load_asset(self, asset_id):
         return self.fetch_one(
@@ -215,7 +317,7 @@ class ProjectDatabase(Database):
 
     def load_asset_list(self):
         return self.fetch_all(
-            'SELECT id, name, type, thumbnail FROM assets;'
+            'SELECT id, name, type, thumbnail, hash FROM assets;'
         )
 
     def db_tup_from_stage_asset(self, stage_asset, stage_id):
@@ -343,6 +445,19 @@ class ArchiveDatabase(Database):
             ('name', 'TEXT'),
             ('description', 'TEXT')
         ])
+        # grids found in images by grid_det.analyse_asset, by digest of the
+        # image file, so that no image needs to be analysed twice. Failures
+        # aren't kept, so that they are retried.
+        self.tables['grids'] = Table('grids', [
+            ('digest', 'INTEGER PRIMARY KEY'),
+            ('spacing_x', 'REAL'),
+            ('spacing_y', 'REAL'),
+            ('offset_x', 'REAL'),
+            ('offset_y', 'REAL'),
+            ('confidence_x', 'REAL'),
+            ('confidence_y', 'REAL'),
+            ('error', 'TEXT')
+        ])
 
     def db_tup_from_asset(self, asset):
         return (
@@ -350,7 +465,7 @@ class ArchiveDatabase(Database):
             asset.name,
             asset.type.value,
             asset.properties,
-            asset.thumbnail.as_bytes(),
+            asset.thumbnail_blob,
             asset.description
         )
 
@@ -381,3 +496,41 @@ class ArchiveDatabase(Database):
 
     def load_project_list(self):
         return self.fetch_all(self.tables['projects'].command('SELECT_ALL'))
+
+    def db_tup_from_grid(self, digest, grid):
+        spacing = grid['spacing'] or (None, None)
+        offset = grid['offset'] or (None, None)
+        return (digest, *spacing, *offset, *grid['confidence'], grid['error'])
+
+    def add_grid(self, digest, grid):
+        """store grid for digest, unless no grid was found"""
+        if grid['error'] is not None:
+            return
+
+        self.execute(
+            self.tables['grids'].command('REPLACE'),
+            self.db_tup_from_grid(digest, grid)
+        )
+
+    def load_grid(self, digest):
+        """the grid stored for digest, as added, or None if there is none"""
+
+        # failures stored by earlier versions are ignored, and replaced once
+        # the image is analysed again
+        tup = self.fetch_one(
+            'SELECT spacing_x, spacing_y, offset_x, offset_y, confidence_x, '
+            'confidence_y, error FROM grids WHERE digest = ? '
+            'AND error IS NULL;',
+            (digest,)
+        )
+        if tup is None:
+            return None
+
+        spacing_x, spacing_y, offset_x, offset_y, confidence_x, \
+            confidence_y, error = tup
+        return {
+            'spacing': None if spacing_x is None else (spacing_x, spacing_y),
+            'offset': None if offset_x is None else (offset_x, offset_y),
+            'confidence': (confidence_x, confidence_y),
+            'error': error
+        }
@@ -0,0 +1,222 @@
+"""
+The map grid is drawn from cached patterns, in any style, rather than line by
+line. Each line is blitted from a strip covering the length of the grid.
+Dense grids whose period is a whole number of frame pixels are instead drawn
+by tiling a block of cells over the frame, which takes a number of blits
+independent of the number of lines.
+"""
+
+import enum
+import math
+
+import gui_util
+import image
+import rect
+
+class GridStyle(enum.Enum):
+    SOLID = 0
+    DOTTED = 1
+    TRANSLUCENT = 2
+
+class GridPainter():
+    # length of the dashes, and of the gaps between them, in dotted lines
+    DOT_LENGTH = 4
+    # alpha of the line colour in the translucent style
+    TRANSLUCENT_ALPHA = 96
+    # tiled blocks of cells are made at least this many pixels across
+    BLOCK_SIZE = 256
+    # blitting a block costs as much as its area, so only grids with cells
+    # at most this many pixels across, which have many lines, are drawn by
+    # tiling blocks rather than a line at a time
+    MAX_BLOCK_PERIOD = 12
+
+    def __init__(self, **kwargs):
+        self.colour = kwargs.get('colour', gui_util.Colours.BLACK)
+        self.style = kwargs.get('style', GridStyle.SOLID)
+
+    @property
+    def line_colour(self):
+        if self.style == GridStyle.TRANSLUCENT:
+            return (*self.colour[:3], GridPainter.TRANSLUCENT_ALPHA)
+        return self.colour
+
+    @property
+    def dash_period(self):
+        """pixels after which the pattern along a line repeats"""
+        if self.style == GridStyle.DOTTED:
+            return 2 * GridPainter.DOT_LENGTH
+        return 1
+
+    def cached(self, key, build):
+        return image.transform_cache.get(
+            ('grid', image.Image, self.colour, self.style, *key),
+            build
+        )
+
+    def new_pattern(self, size):
+        return image.Image(
+            size=size,
+            bg_colour=gui_util.Colours.CLEAR,
+            alpha=self.style == GridStyle.TRANSLUCENT
+        )
+
+    def fill_line(self, pattern, line, horizontal):
+        """
+        fill line, a rect of pattern, in the line colour. Dotted lines are
+        dashed relative to the pattern's origin.
+        """
+
+        if self.style != GridStyle.DOTTED:
+            pattern.fill(self.line_colour, line)
+            return
+
+        x, y, w, h = line
+        start, end = (x, x + w) if horizontal else (y, y + h)
+        dot = GridPainter.DOT_LENGTH
+        for i in range(start - start % (2 * dot), end, 2 * dot):
+            if horizontal:
+                dash = (i, y, dot, h)
+            else:
+                dash = (x, i, w, dot)
+            clip = rect.intersect(dash, line)
+            if clip is not None:
+                pattern.fill(self.line_colour, clip)
+
+    def block(self, period, width):
+        """
+        a square of whole cells, each with lines along its top and left
+        edges, which can be tiled to draw any part of the grid.
+        """
+
+        # the block must also hold whole periods of the dash pattern
+        step = self.dash_period // math.gcd(period, self.dash_period)
+        count = step * max(
+            math.ceil(GridPainter.BLOCK_SIZE / period / step),
+            1
+        )
+        size = period * count
+
+        def build():
+            pattern = self.new_pattern((size, size))
+            for i in range(count):
+                self.fill_line(pattern, (i * period, 0, width, size), False)
+            for i in range(count):
+                line = (0, i * period, size, width)
+                # lines are laid over crossings, rather than blended twice
+                pattern.fill(gui_util.Colours.CLEAR, line)
+                self.fill_line(pattern, line, True)
+            return pattern
+
+        return self.cached(('block', period, width), build)
+
+    def strip(self, length, width, horizontal, crossings=None):
+        """
+        a line running the length of the grid. If crossings is given, as the
+        (tile, scale) of the lines crossing this one, the line is broken
+        where they cross it.
+        """
+
+        def build():
+            size = (length, width) if horizontal else (width, length)
+            pattern = self.new_pattern(size)
+            self.fill_line(pattern, (0, 0, *size), horizontal)
+            if crossings is not None:
+                tile, scale = crossings
+                for i in range(math.ceil(length / scale / tile) + 1):
+                    gap = math.floor(i * tile * scale)
+                    if horizontal:
+                        gap_rect = (gap, 0, width, width)
+                    else:
+                        gap_rect = (0, gap, width, width)
+                    pattern.fill(gui_util.Colours.CLEAR, gap_rect)
+            return pattern
+
+        return self.cached(
+            ('strip', length, width, horizontal, crossings),
+            build
+        )
+
+    def draw(self, frame, region, grid_rect, tile, scale, width, counts):
+        """
+        draw the grid lines crossing region of frame. grid_rect is the
+        extent of the grid in the frame, tile the period of its lines in map
+        pixels, scale the frame pixels per map pixel, width the width of its
+        lines in frame pixels and counts the number of cells across and down.
+        """
+
+        region = rect.intersect(region, grid_rect)
+        if region is None:
+            return
+
+        period = tile * scale
+        if float(scale).is_integer() and \
+            period <= GridPainter.MAX_BLOCK_PERIOD:
+
+            self.draw_blocks(
+                frame,
+                region,
+                grid_rect[:2],
+                self.block(int(period), width)
+            )
+        else:
+            self.draw_lines(
+                frame,
+                region,
+                grid_rect,
+                (tile, scale),
+                width,
+                counts
+            )
+
+    def draw_blocks(self, frame, region, origin, block):
+        """tile block over region, with a block's corner at origin"""
+        x, y, w, h = region
+        origin_x, origin_y = origin
+        size = block.w
+        left = origin_x + (x - origin_x) // size * size
+        top = origin_y + (y - origin_y) // size * size
+
+        for block_y in range(top, y + h, size):
+            for block_x in range(left, x + w, size):
+                clip = rect.intersect((block_x, block_y, size, size), region)
+                if clip is not None:
+                    cx, cy, cw, ch = clip
+                    frame.blit(
+                        block,
+                        (cx, cy),
+                        (cx - block_x, cy - block_y, cw, ch)
+                    )
+
+    def draw_lines(self, frame, region, grid_rect, period, width, counts):
+        """blit each line crossing region from a strip"""
+        grid_x, grid_y, grid_w, grid_h = grid_rect
+        tile, scale = period
+        cols, rows = counts
+        x, y, w, h = region
+
+        def positions(start, length, count):
+            first = max(math.floor((start - width) / scale / tile), 0)
+            last = min(math.ceil((start + length) / scale / tile), count)
+            # the same expression as is used to place assets, so that lines
+            # round in the same direction as the assets beside them
+            return [
+                math.floor(i * tile * scale)
+                for i in range(first, last + 1)
+            ]
+
+        horizontal = self.strip(grid_w, width, True)
+        vertical = self.strip(grid_h, width, False, period)
+
+        for line_y in positions(y - grid_y, h, rows):
+            line = (grid_x, grid_y + line_y, grid_w, width)
+            GridPainter.blit_line(frame, horizontal, line, region)
+        for line_x in positions(x - grid_x, w, cols):
+            line = (grid_x + line_x, grid_y, width, grid_h)
+            GridPainter.blit_line(frame, vertical, line, region)
+
+    @staticmethod
+    def blit_line(frame, strip, line, region):
+        clip = rect.intersect(line, region)
+        if clip is not None:
+            cx, cy, cw, ch = clip
+            frame.blit(strip, (cx, cy), (cx - line[0], cy - line[1], cw, ch))
@@ -0,0 +1,382 @@
+"""
+Accuracy and speed benchmarks for grid detection. A corpus of synthetic
+battlemaps is generated with known grid spacing, offset and line width,
+with noise, jpeg artefacts and grids covering only part of the map, and each
+detector in grid_det is run over it. The accuracy, failure rate and time per
+megapixel of each are printed and written to a json file, so that the
+detectors' parameters can be tuned against the corpus.
+
+    python grid_bench.py --out grid_bench_results.json
+    python grid_bench.py --sweep OUTLIER_DEVIATIONS=2,2.5,3,4
+"""
+
+import argparse
+import io
+import json
+import os
+import time
+
+# must be set before pygame is imported so that no window is needed
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import numpy as np
+import PIL.Image
+
+import assets
+import bench
+import grid_det
+import image
+
+CASE_COUNT = 200
+# range of the width and height of maps, in pixels
+MAP_SIZE_RANGE = (600, 2400)
+# range of the spacing of grid lines, in pixels
+SPACING_RANGE = (20, 160)
+LINE_WIDTHS = [1, 1, 1.5, 2, 3, 4]
+# range of the standard deviation of noise added to each channel
+NOISE_RANGE = (0, 24)
+# range of qualities maps saved as jpegs are saved at
+JPEG_QUALITY_RANGE = (30, 95)
+# fraction of maps which are saved as jpegs, and of maps whose grid only
+# covers some of it
+JPEG_FRACTION = 0.5
+PARTIAL_FRACTION = 0.3
+# a spacing is correct if it is within this fraction of the true spacing,
+# and an offset if it is within this many pixels of the true offset
+SPACING_TOLERANCE = 0.01
+OFFSET_TOLERANCE = 1.5
+MANIFEST_FILE = 'manifest.jsonl'
+
+def line_coverage(length, spacing, offset, width):
+    """
+    the fraction of each pixel along an axis of the given length covered by
+    lines of width whose centres are spacing apart, the first at offset
+    """
+
+    centres = np.arange(length) + 0.5
+    distance = np.abs((centres - offset + spacing / 2) % spacing - spacing / 2)
+    return np.clip(width / 2 + 0.5 - distance, 0, min(width, 1))
+
+def background(w, h, rng):
+    """a smoothly varying coloured texture with some walls drawn over it"""
+    coarse = rng.integers(40, 220, (h // 96 + 2, w // 96 + 2, 3), np.uint8)
+    pixels = np.asarray(
+        PIL.Image.fromarray(coarse).resize((w, h), PIL.Image.BICUBIC),
+        dtype=np.float64
+    )
+
+    for _ in range(rng.integers(0, 12)):
+        x, y = rng.integers(0, w), rng.integers(0, h)
+        if rng.random() < 0.5:
+            wall = (slice(y, y + rng.integers(4, 16)), slice(x, x + w // 3))
+        else:
+            wall = (slice(y, y + h // 3), slice(x, x + rng.integers(4, 16)))
+        pixels[wall] = rng.integers(0, 256, 3)
+
+    return pixels
+
+def synthetic_case(rng):
+    """parameters of a random map; the truth the detectors are scored on"""
+    w, h = (int(n) for n in rng.integers(*MAP_SIZE_RANGE, 2))
+    spacing = float(rng.uniform(*SPACING_RANGE))
+    if rng.random() < 0.5:
+        spacing = float(round(spacing))
+
+    partial = None
+    if rng.random() < PARTIAL_FRACTION:
+        part_w, part_h = int(w * rng.uniform(0.4, 0.9)), \
+            int(h * rng.uniform(0.4, 0.9))
+        partial = [
+            int(rng.integers(0, w - part_w + 1)),
+            int(rng.integers(0, h - part_h + 1)),
+            part_w,
+            part_h
+        ]
+
+    return {
+        'size': [w, h],
+        'spacing': spacing,
+        'offset': [float(rng.uniform(0, spacing)) for _ in range(2)],
+        'line_width': float(rng.choice(LINE_WIDTHS)),
+        'line_colour': [int(c) for c in rng.integers(0, 80, 3)],
+        'opacity': float(rng.uniform(0.3, 1)),
+        'noise': float(rng.uniform(*NOISE_RANGE)),
+        'jpeg_quality': int(rng.integers(*JPEG_QUALITY_RANGE)) \
+            if rng.random() < JPEG_FRACTION else None,
+        'partial': partial,
+        'seed': int(rng.integers(2 ** 31))
+    }
+
+def render_case(case):
+    """return the map described by case, encoded as it would be saved"""
+    rng = np.random.default_rng(case['seed'])
+    w, h = case['size']
+    spacing = case['spacing']
+    offset_x, offset_y = case['offset']
+
+    pixels = background(w, h, rng)
+    cover = np.maximum(
+        line_coverage(w, spacing, offset_x, case['line_width'])[None, :],
+        line_coverage(h, spacing, offset_y, case['line_width'])[:, None]
+    ) * case['opacity']
+    if case['partial'] is not None:
+        x, y, part_w, part_h = case['partial']
+        mask = np.zeros((h, w))
+        mask[y:y + part_h, x:x + part_w] = 1
+        cover *= mask
+    cover = cover[:, :, None]
+    pixels = pixels * (1 - cover) + np.array(case['line_colour']) * cover
+    pixels += rng.normal(0, case['noise'], pixels.shape)
+
+    img = PIL.Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    blob = io.BytesIO()
+    if case['jpeg_quality'] is None:
+        img.save(blob, format='PNG', compress_level=1)
+    else:
+        img.save(blob, format='JPEG', quality=case['jpeg_quality'])
+    return blob.getvalue()
+
+def case_file(case, i):
+    return f'{i:04}.' + ('png' if case['jpeg_quality'] is None else 'jpg')
+
+def load_corpus(path, count, seed):
+    """
+    return the cases of the corpus in the directory path, generating count
+    cases from seed and saving them there first if it has none. If path is
+    None, the cases are generated but not saved.
+    """
+
+    manifest = None if path is None else os.path.join(path, MANIFEST_FILE)
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            return [json.loads(line) for line in f]
+
+    rng = np.random.default_rng(seed)
+    cases = [synthetic_case(rng) for _ in range(count)]
+    if manifest is not None:
+        os.makedirs(path, exist_ok=True)
+        with open(manifest, 'w') as f:
+            for i, case in enumerate(cases):
+                case['file'] = case_file(case, i)
+                with open(os.path.join(path, case['file']), 'wb') as img:
+                    img.write(render_case(case))
+                f.write(json.dumps(case) + '\n')
+
+    return cases
+
+def load_case(case, path):
+    """the map of case, as an ImageAsset"""
+    if path is None:
+        blob = render_case(case)
+    else:
+        with open(os.path.join(path, case['file']), 'rb') as f:
+            blob = f.read()
+    return assets.ImageAsset(image=image.Image.from_bytes(blob))
+
+def detect_histogram(asset):
+    row, col = grid_det.calc_grid_size(asset.image.as_greyscale_array())
+    return (col, row), None
+
+def detect_autocorrelation(asset):
+    (period_x, offset_x, conf_x), (period_y, offset_y, conf_y) = \
+        grid_det.detect_grid(asset.image.as_greyscale_array())
+    if min(conf_x, conf_y) < grid_det.MIN_CONFIDENCE:
+        raise ValueError('Failed to find grid in input.')
+    return (period_x, period_y), (offset_x, offset_y)
+
+def detect_analyse(asset):
+    grid = grid_det.analyse_asset(asset)
+    if grid['error'] is not None:
+        raise ValueError(grid['error'])
+    return grid['spacing'], grid['offset']
+
+# each takes an ImageAsset and returns the spacing of its grid along x and
+# y, and the offset, or None if the detector finds no offset
+DETECTORS = {
+    'histogram': detect_histogram,
+    'autocorrelation': detect_autocorrelation,
+    'analyse': detect_analyse
+}
+
+def score(case, spacing, offset):
+    """whether the spacing and offset found for case are correct"""
+    truth = case['spacing']
+    spacing_ok = all(
+        abs(s - truth) <= truth * SPACING_TOLERANCE for s in spacing
+    )
+
+    offset_ok = None
+    if offset is not None:
+        offset_ok = spacing_ok and all(
+            abs((o - t + truth / 2) % truth - truth / 2) <= OFFSET_TOLERANCE
+            for o, t in zip(offset, case['offset'])
+        )
+
+    return spacing_ok, offset_ok
+
+def case_tags(case):
+    """conditions of case which results are broken down by"""
+    tags = ['all']
+    tags.append('jpeg' if case['jpeg_quality'] is not None else 'png')
+    if case['partial'] is not None:
+        tags.append('partial')
+    if case['line_width'] <= 1:
+        tags.append('thin')
+    if case['noise'] > NOISE_RANGE[1] / 2:
+        tags.append('noisy')
+    if not float(case['spacing']).is_integer():
+        tags.append('fractional')
+    return tags
+
+def summarise(results):
+    """accuracy, failure rate and speed of results, by tag"""
+    summary = {}
+    for result in results:
+        for tag in result['tags']:
+            summary.setdefault(tag, []).append(result)
+
+    for tag, tagged in summary.items():
+        offsets = [
+            r['offset_ok'] for r in tagged if r['offset_ok'] is not None
+        ]
+        megapixels = sum(r['megapixels'] for r in tagged)
+        summary[tag] = {
+            'cases': len(tagged),
+            'accuracy': sum(r['spacing_ok'] for r in tagged) / len(tagged),
+            'failure_rate': sum(r['error'] is not None for r in tagged) / \
+                len(tagged),
+            'offset_accuracy': sum(offsets) / len(offsets) if offsets \
+                else None,
+            'ms_per_megapixel': \
+                1000 * sum(r['seconds'] for r in tagged) / megapixels
+        }
+    return summary
+
+def bench_detectors(names, cases, path):
+    """run the named detectors over cases, returning the results of each"""
+    results = {name: [] for name in names}
+    for case in cases:
+        # loaded once for every detector, as generating cases is slow
+        asset = load_case(case, path)
+        w, h = case['size']
+
+        for name in names:
+            result = {
+                'tags': case_tags(case),
+                'megapixels': w * h / 1e6,
+                'spacing': None,
+                'offset': None,
+                'spacing_ok': False,
+                'offset_ok': None,
+                'error': None
+            }
+
+            start = time.perf_counter()
+            try:
+                spacing, offset = DETECTORS[name](asset)
+            except ValueError as e:
+                result['error'] = str(e)
+            else:
+                result['spacing'] = [float(s) for s in spacing]
+                if offset is not None:
+                    result['offset'] = [float(o) for o in offset]
+                result['spacing_ok'], result['offset_ok'] = \
+                    score(case, spacing, offset)
+            result['seconds'] = time.perf_counter() - start
+
+            results[name].append(result)
+
+    return results
+
+def set_parameter(assignment):
+    """set a module constant of grid_det from a NAME=VALUE string"""
+    name, value = assignment.split('=', 1)
+    if not name.isupper() or not hasattr(grid_det, name):
+        raise ValueError(f'grid_det has no parameter {name}')
+    value = float(value)
+    if isinstance(getattr(grid_det, name), int) and value.is_integer():
+        value = int(value)
+    setattr(grid_det, name, value)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--out', default='grid_bench_results.json')
+    parser.add_argument('--count', type=int, default=CASE_COUNT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--corpus',
+        default=None,
+        help='directory the corpus is read from, or generated into if it '
+        'has none; by default it is generated in memory'
+    )
+    parser.add_argument(
+        '--detectors',
+        nargs='+',
+        default=list(DETECTORS),
+        choices=list(DETECTORS)
+    )
+    parser.add_argument(
+        '--set',
+        action='append',
+        default=[],
+        metavar='NAME=VALUE',
+        help='set a parameter of grid_det, such as WINDOW_SIZE=21'
+    )
+    parser.add_argument(
+        '--sweep',
+        default=None,
+        metavar='NAME=VALUE,...',
+        help='run the detectors once with each value of a parameter'
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    for assignment in args.set:
+        set_parameter(assignment)
+    sweep = [None]
+    if args.sweep is not None:
+        name, values = args.sweep.split('=', 1)
+        sweep = [f'{name}={value}' for value in values.split(',')]
+
+    cases = load_corpus(args.corpus, args.count, args.seed)
+    results = {
+        'commit': bench.get_commit(),
+        'time': time.time(),
+        'environment': bench.get_environment(),
+        'corpus': {'count': len(cases), 'seed': args.seed},
+        'parameters': args.set,
+        'runs': []
+    }
+
+    for assignment in sweep:
+        if assignment is not None:
+            set_parameter(assignment)
+
+        detector_results = bench_detectors(args.detectors, cases, args.corpus)
+        for name, cases_results in detector_results.items():
+            summary = summarise(cases_results)
+            results['runs'].append({
+                'detector': name,
+                'parameter': assignment,
+                'summary': summary,
+                'cases': cases_results
+            })
+
+            print(f'{name}' + (f' {assignment}' if assignment else ''))
+            for tag, s in summary.items():
+                offset = '-' if s['offset_accuracy'] is None \
+                    else f'{s["offset_accuracy"]:.2f}'
+                print(
+                    f'    {tag:10} cases={s["cases"]:<4} '
+                    f'accuracy={s["accuracy"]:.2f} '
+                    f'failures={s["failure_rate"]:.2f} offsets={offset} '
+                    f'{s["ms_per_megapixel"]:.1f}ms/MP'
+                )
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
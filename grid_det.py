@@ -1,8 +1,47 @@
+import concurrent.futures
+import glob
+import json
+import math
+import os
+
 import numpy as np
 
+import database
 import image
+import util
 
 MIN_GRID_SIZE = 10
+# number of preceding rows a row is compared against
+WINDOW_SIZE = 15
+# standard deviations from the average of the rows up to a row at which it
+# stands out. A row is part of its own window, so it can't stand out by more
+# than (WINDOW_SIZE - 1) / sqrt(WINDOW_SIZE) deviations, 3.6 for 15 rows
+OUTLIER_DEVIATIONS = 3
+# rows or columns whose deviations are computed at once
+STDDEV_BLOCK = 16
+# below this confidence, a period found by get_profile_period is unreliable
+MIN_CONFIDENCE = 0.5
+# the period is the shortest lag whose autocorrelation is at least this
+# fraction of the highest
+FUNDAMENTAL_RATIO = 0.8
+# gaussian blur applied to profiles before they are autocorrelated
+SMOOTHING_KERNEL = np.exp(-np.arange(-4, 5) ** 2 / (2 * 1.5 ** 2))
+# periods tried within a pixel either side of the best lag
+PERIOD_STEPS = 201
+# rounds of fitting the period and offset to the lines near them; lines are
+# taken to be near ever closer each round
+FIT_ITERATIONS = 5
+# a period must repeat at least this many times along an axis to be found
+MIN_LINES = 4
+# fractions of a period which are also tried, in case lines were missed
+SUBMULTIPLES = (2, 3)
+# sizes which images are downscaled to fit for detect_grid_multiscale, from
+# the first tried to the last
+COARSE_SIZES = (1024, 2048, 4096)
+# length and thickness of the strips of the full size image which the grid
+# is refined on
+STRIP_LENGTH = 2048
+STRIP_THICKNESS = 256
 
 def load_as_greyscale(path):
     """load specified path as a greyscale image"""
@@ -10,40 +49,69 @@ def load_as_greyscale(path):
 
 def get_row_col_stddev(img):
     """return vectors of standard deviations of value for a greyscale image"""
-    rows = [np.std(row) for row in img]
-    cols = [np.std(img[:,j]) for j in range(len(img[0]))]
+    h, w = img.shape
+    rows = np.empty(h)
+    cols = np.empty(w)
+
+    # worked through a few rows or columns at a time, so that the floating
+    # point copies made by np.std stay small. Columns are copied out to be
+    # contiguous, as reducing down them in place sums in a different order,
+    # giving slightly different results.
+    for i in range(0, h, STDDEV_BLOCK):
+        rows[i:i + STDDEV_BLOCK] = np.std(img[i:i + STDDEV_BLOCK], axis=1)
+    for j in range(0, w, STDDEV_BLOCK):
+        block = np.ascontiguousarray(img[:, j:j + STDDEV_BLOCK].T)
+        cols[j:j + STDDEV_BLOCK] = np.std(block, axis=1)
 
     return rows, cols
 
-def get_row_deltas(rows, k=3):
+def get_outliers(rows, k=None):
+    """
+    given an input array rows which is a vector of standard deviations of
+    image rows, return a boolean vector of the rows which are k standard
+    deviations away from the average of the last 15 rows. k defaults to
+    OUTLIER_DEVIATIONS.
+    """
+
+    if k is None:
+        k = OUTLIER_DEVIATIONS
+    rows = np.asarray(rows, dtype=np.float64)
+    n = min(WINDOW_SIZE, len(rows))
+    if not n:
+        return np.zeros(0, dtype=bool)
+
+    # the window for the first rows is padded with the first rows again
+    padded = np.concatenate((rows[:n], rows))
+    windows = np.ascontiguousarray(
+        np.lib.stride_tricks.sliding_window_view(padded, n)[1:]
+    )
+    return np.abs(windows.mean(axis=1) - rows) > windows.std(axis=1) * k
+
+def get_row_deltas(rows, k=None):
     """
     given an input array rows which is a vector of standard deviations of
     image rows, return a dictionary which maps distances between rows
     which satisfy the condition of being k standard deviations away
     from the average of the last 15 rows to frequency of this distance.
     """ 
-    
-    prev = rows[:15] # the past 15 rows
-    indexs = []
-    for i, r in enumerate(rows):
-        prev.append(r)
-        prev = prev[1:]
-        
-        if abs(np.mean(prev) - r) > np.std(prev) * k:
-            indexs.append(i)
-
-    deltas = {}
-    for i in range(len(indexs) - 1):
-        d = indexs[i + 1] - indexs[i]
-        if not d in deltas:
-            deltas[d] = 0
-        deltas[d] += 1
-
-    return deltas
+
+    outliers = np.flatnonzero(get_outliers(rows, k))
+
+    # keyed in order of first occurrence, which breaks ties in picking
+    deltas, first, counts = np.unique(
+        np.diff(outliers),
+        return_index=True,
+        return_counts=True
+    )
+    order = np.argsort(first, kind='stable')
+    return {int(deltas[i]): int(counts[i]) for i in order}
 
 def pick_grid_size(deltas, d=20):
     """select grid size from delta dictionary"""
 
+    if not deltas:
+        raise ValueError('Failed to find grid in input.')
+
     # count multiples of a given delta (> d) as entries for that delta
     copy = deltas.copy()
     for delta in deltas:
@@ -54,6 +122,253 @@ def pick_grid_size(deltas, d=20):
 
     return max(deltas, key=lambda k: deltas[k] * k)
 
+def get_line_mask(*profiles):
+    """
+    return a boolean vector of the rows which stand out in any of profiles,
+    and so may be grid lines. Rows are compared both ways, so that every row
+    of a thick line stands out.
+    """
+
+    mask = np.zeros(len(profiles[0]), dtype=bool)
+    for profile in profiles:
+        profile = np.asarray(profile, dtype=np.float64)
+        mask |= get_outliers(profile) | get_outliers(profile[::-1])[::-1]
+    return mask
+
+def get_line_centres(mask):
+    """centres of the runs of true values in a boolean vector"""
+    indices = np.flatnonzero(mask)
+    if not len(indices):
+        return indices.astype(np.float64)
+
+    breaks = np.flatnonzero(np.diff(indices) > 1)
+    starts = np.concatenate(([indices[0]], indices[breaks + 1]))
+    ends = np.concatenate((indices[breaks], [indices[-1]]))
+    # + 0.5 to measure to the middle of the pixels
+    return (starts + ends) / 2 + 0.5
+
+def fit_lines(centres, period, offset):
+    """
+    fit a period and offset to the line centres within a small distance of
+    the lines they predict, by least squares, returning (period, offset).
+    The distance halves with each round of fitting, so that other features
+    near the lines stop pulling on the fit as it closes in.
+    """
+
+    distance = period / 8
+    for _ in range(FIT_ITERATIONS):
+        index = np.round((centres - offset) / period)
+        near = np.abs(centres - offset - index * period) < max(distance, 2)
+        if len(np.unique(index[near])) < 2:
+            break
+        design = np.stack((np.ones(np.count_nonzero(near)), index[near]), 1)
+        offset, period = np.linalg.lstsq(
+            design,
+            centres[near],
+            rcond=None
+        )[0]
+        distance /= 2
+
+    return period, offset
+
+def get_line_hits(centres, period, offset, length):
+    """
+    the fraction of the lines predicted by period and offset along an axis
+    of the given length which are at one of the sorted line centres
+    """
+
+    predicted = np.arange(offset % period, length, period)
+    if not len(predicted) or not len(centres):
+        return 0.0
+
+    # distance from each predicted line to the nearest centre either side
+    after = np.minimum(np.searchsorted(centres, predicted), len(centres) - 1)
+    before = np.maximum(after - 1, 0)
+    distance = np.minimum(
+        np.abs(centres[after] - predicted),
+        np.abs(centres[before] - predicted)
+    )
+    return float(np.mean(distance < max(period / 16, 1.5)))
+
+def get_profile_period(*profiles, min_period=None):
+    """
+    find the spacing of grid lines from profiles of an image along one axis,
+    such as the deviations and means of its rows, from the autocorrelation
+    of the rows which stand out. Returns (period, offset, confidence), where
+    offset is the distance from the edge of the image to the centre of the
+    first grid line and confidence is between 0 and 1. If no period is found
+    the confidence is 0. Periods shorter than min_period, by default
+    MIN_GRID_SIZE, aren't considered.
+    """
+
+    if min_period is None:
+        min_period = MIN_GRID_SIZE
+    n = len(profiles[0])
+    if n < MIN_LINES * min_period + 1:
+        return 0.0, 0.0, 0.0
+
+    mask = get_line_mask(*profiles)
+    signal = mask - mask.mean()
+    # blurred so that thin lines still correlate when the period isn't a
+    # whole number of pixels, as their positions then jitter
+    signal = np.convolve(signal, SMOOTHING_KERNEL, 'same')
+
+    spectrum = np.fft.rfft(signal, 2 * n)
+    autocorr = np.fft.irfft(spectrum * spectrum.conj(), 2 * n)[:n]
+    if autocorr[0] <= 0:
+        return 0.0, 0.0, 0.0
+    # normalised by the number of products in each lag
+    autocorr = autocorr / np.arange(n, 0, -1)
+    autocorr /= autocorr[0]
+
+    # multiples of the period correlate about as well as the period itself,
+    # so take the shortest lag which correlates nearly as well as the best
+    lags = autocorr[min_period - 1:n // MIN_LINES + 2]
+    peaks = min_period + np.flatnonzero(
+        (lags[1:-1] >= lags[:-2]) & (lags[1:-1] >= lags[2:])
+    )
+    if not len(peaks):
+        return 0.0, 0.0, 0.0
+    best = autocorr[peaks].max()
+    lag = peaks[np.argmax(autocorr[peaks] >= best * FUNDAMENTAL_RATIO)]
+    confidence = min(max(float(autocorr[lag]), 0.0), 1.0)
+
+    centres = get_line_centres(mask)
+    if len(centres) < 2:
+        return 0.0, 0.0, 0.0
+
+    # the lag is a whole number of pixels; the period is the one nearby at
+    # which the lines fall most nearly in phase
+    candidates = lag + np.linspace(-1, 1, PERIOD_STEPS)
+    phases = np.exp(-2j * np.pi * centres / candidates[:, np.newaxis])
+    fits = phases.sum(axis=1)
+    best = np.argmax(np.abs(fits))
+    period = candidates[best]
+    offset = -np.angle(fits[best]) / (2 * np.pi) * period
+
+    period, offset = fit_lines(centres, period, offset)
+
+    # the lines of a grid can correlate better at a multiple of its period
+    # than at the period, as when the period isn't a whole number of pixels
+    # every other line is blurred differently. A fraction of the period is
+    # taken instead if the lines it predicts are found nearly as often.
+    hits = get_line_hits(centres, period, offset, n)
+    divided = True
+    while divided:
+        divided = False
+        for divisor in SUBMULTIPLES:
+            if period / divisor < min_period:
+                continue
+            fraction, fraction_offset = fit_lines(
+                centres,
+                period / divisor,
+                offset
+            )
+            fraction_hits = get_line_hits(
+                centres,
+                fraction,
+                fraction_offset,
+                n
+            )
+            if fraction_hits >= hits * FUNDAMENTAL_RATIO:
+                period, offset, hits = fraction, fraction_offset, \
+                    fraction_hits
+                divided = True
+                break
+
+    return float(period), float(offset % period), confidence
+
+def get_profiles(grey):
+    """
+    return the deviations and means of the rows of a greyscale image, and
+    then those of its columns. Lines which are uniform stand out in the
+    deviations, but once an image is scaled down they blend with what is
+    around them, and only stand out in the means.
+    """
+
+    rows, cols = get_row_col_stddev(grey)
+    return (rows, grey.mean(axis=1)), (cols, grey.mean(axis=0))
+
+def detect_grid(grey):
+    """
+    find the grid in a greyscale image from the periodicity of its columns
+    and rows. Returns a (period, offset, confidence) tuple for each of the x
+    and y axes, as from get_profile_period.
+    """
+
+    rows, cols = get_profiles(grey)
+    return get_profile_period(*cols), get_profile_period(*rows)
+
+def refine_axis(estimate, length, read_profiles):
+    """
+    refine an estimate of the (period, offset, confidence) of the grid along
+    an axis of the given length, measured on a downscaled image, on strips of
+    the full size image. read_profiles(start, length) returns profiles, as
+    from get_profiles, of the strip covering that span of the axis. Strips
+    are taken ever further apart, each fit extending the last, so that few
+    are needed to measure the period precisely over the whole axis.
+    """
+
+    period, offset, confidence = estimate
+    if confidence < MIN_CONFIDENCE:
+        return estimate
+
+    strip = min(max(STRIP_LENGTH, math.ceil(period * 8)), length)
+    starts = []
+    start = 0
+    while start + strip < length:
+        starts.append(start)
+        start = 2 * start + strip
+    starts.append(length - strip)
+
+    centres = np.zeros(0)
+    for start in starts:
+        found = get_line_centres(get_line_mask(*read_profiles(start, strip)))
+        found += start
+        centres = np.concatenate((centres, found))
+        period, offset = fit_lines(centres, period, offset)
+
+    return float(period), float(offset % period), confidence
+
+def detect_grid_multiscale(size, read_downscaled, read_grey):
+    """
+    find the grid in an image of the given size without reading all of it
+    at full size. It is first found on a downscaled copy, then refined on
+    strips through the middle of the full size image. read_downscaled(size)
+    returns a greyscale array of the image scaled down to fit in size and
+    read_grey(rect) a greyscale array of a region at full size. Returns the
+    same as detect_grid, measured at full size.
+    """
+
+    w, h = size
+    for coarse_size in COARSE_SIZES:
+        grey = read_downscaled((coarse_size, coarse_size))
+        scale_x, scale_y = w / grey.shape[1], h / grey.shape[0]
+        (period_x, offset_x, conf_x), (period_y, offset_y, conf_y) = \
+            detect_grid(grey)
+        # finer levels are only read if the grid isn't clear at this one
+        if min(conf_x, conf_y) >= MIN_CONFIDENCE:
+            break
+
+    thickness_x = min(STRIP_THICKNESS, w)
+    thickness_y = min(STRIP_THICKNESS, h)
+    middle_x = (w - thickness_x) // 2
+    middle_y = (h - thickness_y) // 2
+
+    return refine_axis(
+        (period_x * scale_x, offset_x * scale_x, conf_x),
+        w,
+        lambda start, length: get_profiles(
+            read_grey((start, middle_y, length, thickness_y))
+        )[1]
+    ), refine_axis(
+        (period_y * scale_y, offset_y * scale_y, conf_y),
+        h,
+        lambda start, length: get_profiles(
+            read_grey((middle_x, start, thickness_x, length))
+        )[0]
+    )
+
 def calc_grid_size(grey):
     rows, cols = get_row_col_stddev(grey)
     row_size = pick_grid_size(get_row_deltas(rows))
@@ -64,6 +379,208 @@ def calc_grid_size(grey):
 
     return row_size, col_size
 
+def analyse(size, read_downscaled, read_grey):
+    """
+    find the grid in an image of size, read through read_downscaled and
+    read_grey as by detect_grid_multiscale. Returns a dict of the 'spacing'
+    and 'offset' of its lines along x and y, in image pixels, the
+    'confidence' of each and an 'error', which is None unless no grid was
+    found, when it says why. If the grid isn't found confidently, the
+    spacing is instead that found by calc_grid_size, and the offset is None.
+    """
+
+    (period_x, offset_x, conf_x), (period_y, offset_y, conf_y) = \
+        detect_grid_multiscale(size, read_downscaled, read_grey)
+    grid = {
+        'spacing': (period_x, period_y),
+        'offset': (offset_x, offset_y),
+        'confidence': (conf_x, conf_y),
+        'error': None
+    }
+    if min(conf_x, conf_y) >= MIN_CONFIDENCE:
+        return grid
+
+    # the histogram detector finds no offset, only the spacing
+    w, h = size
+    grey = read_downscaled((COARSE_SIZES[-1],) * 2)
+    try:
+        row, col = calc_grid_size(grey)
+    except ValueError as e:
+        grid.update(spacing=None, offset=None, error=str(e))
+    else:
+        grid.update(
+            spacing=(col * w / grey.shape[1], row * h / grey.shape[0]),
+            offset=None
+        )
+    return grid
+
+def analyse_asset(asset):
+    """analyse for an image asset"""
+
+    # the image is only read at full size in a few strips, so that huge maps
+    # aren't converted to greyscale whole
+    return analyse(
+        asset.size,
+        lambda size: asset.downscaled(size).as_greyscale_array(),
+        lambda rect: asset.read_region(rect).as_greyscale_array()
+    )
+
+def analyse_file(path):
+    """
+    analyse for the image at path, recording why it couldn't be. The file is
+    read straight into greyscale, rather than into an asset, which would be
+    tiled, digested and thumbnailed.
+    """
+
+    def read_downscaled(size):
+        # halved until it fits, like an asset's mipmaps
+        max_w, max_h = size
+        factor = 1
+        while w // factor > max_w or h // factor > max_h:
+            factor *= 2
+        return np.asarray(grey.reduce(factor))
+
+    def read_grey(rect):
+        x, y, rect_w, rect_h = rect
+        return pixels[y:y + rect_h, x:x + rect_w]
+
+    try:
+        grey = image.open_large(path).convert('L')
+        pixels = np.asarray(grey)
+        w, h = grey.size
+        return analyse((w, h), read_downscaled, read_grey)
+    except Exception as e:
+        # one unreadable image shouldn't stop a batch
+        return {
+            'spacing': None,
+            'offset': None,
+            'confidence': (0.0, 0.0),
+            'error': str(e) or type(e).__name__
+        }
+
+def find_images(patterns):
+    """
+    yield the paths of the images named by patterns, each of which may be a
+    file, a glob or a directory, which is searched for images recursively.
+    Patterns which match nothing are yielded as they are, to fail later.
+    """
+
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                paths = []
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    paths.extend(
+                        os.path.join(root, f) for f in sorted(files)
+                        if util.get_file_extension(f) in image.Image.FORMATS
+                    )
+            else:
+                paths = [match]
+
+            for path in paths:
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+def run_batch(paths, out, cache=None, jobs=None):
+    """
+    analyse the images at paths on a pool of jobs processes, writing the
+    result for each to out as a line of json. Results are looked up in and
+    added to cache, an ArchiveDatabase, by the digest of each file, so that
+    images which have already been analysed aren't read again. Images in
+    which no grid was found aren't cached, and are analysed again each run.
+    """
+
+    def write(path, digest, grid):
+        out.write(json.dumps({'path': path, 'digest': digest, **grid}) + '\n')
+        out.flush()
+
+    # paths of the images still to be analysed, by digest, so that copies of
+    # an image are only analysed once
+    pending = {}
+    for path in paths:
+        try:
+            digest = util.file_digest(path)
+        except OSError as e:
+            write(path, None, {
+                'spacing': None,
+                'offset': None,
+                'confidence': (0.0, 0.0),
+                'error': e.strerror or str(e)
+            })
+            continue
+
+        grid = None if cache is None else cache.load_grid(digest)
+        if grid is None:
+            pending.setdefault(digest, []).append(path)
+        else:
+            write(path, digest, grid)
+
+    if not pending:
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {
+            pool.submit(analyse_file, same[0]): digest
+            for digest, same in pending.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            digest = futures[future]
+            grid = future.result()
+            if cache is not None:
+                # committed as it goes, so an interrupted batch resumes
+                cache.add_grid(digest, grid)
+                cache.commit()
+            for path in pending[digest]:
+                write(path, digest, grid)
+
 if __name__ == '__main__':
+    import argparse
     import sys
-    print(calc_grid_size(load_as_greyscale(sys.argv[1])))
+
+    parser = argparse.ArgumentParser(
+        description='find the grids in battlemap images, writing the '
+        'spacing and offset of each as a line of json'
+    )
+    parser.add_argument(
+        'paths',
+        nargs='+',
+        help='image files, directories of them or globs'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=None,
+        help='processes to analyse images on; one per cpu by default'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        type=argparse.FileType('w'),
+        default=sys.stdout,
+        help='file to write results to; standard output by default'
+    )
+    parser.add_argument(
+        '--archive',
+        default=util.ARCHIVE_FILE,
+        help='archive database results are cached in'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='analyse every image again, without reading or storing results'
+    )
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache:
+        os.makedirs(os.path.dirname(args.archive) or '.', exist_ok=True)
+        cache = database.ArchiveDatabase(args.archive).init()
+
+    try:
+        run_batch(find_images(args.paths), args.output, cache, args.jobs)
+    finally:
+        if cache is not None:
+            cache.close()
@@ -1,5 +1,4 @@
 import threading
-import time
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.messagebox
@@ -7,11 +6,16 @@ import tkinter.messagebox
 import battlemap
 import gui_util
 import library
+import presenter
+import profiling
 
 root = tk.Tk()
 running = True
 context = library.DataContext()
-bm = battlemap.BattleMap(stage=context.project.active_stage)
+bm = battlemap.BattleMap(
+    stage=context.project.active_stage,
+    grid_cache=context.archive
+)
 
 def get_image_path():
     path = tkinter.filedialog.askopenfilename(
@@ -41,7 +45,8 @@ def add_image():
         return
 
     try:
-        context.load_asset(path)
+        with bm.lock:
+            context.load_asset(path)
     except ValueError:
         tkinter.messagebox.showerror('Error', 'Failed to load image.')
 
@@ -51,7 +56,8 @@ def add_token():
         return
 
     try:
-        context.load_asset(path, token=True)
+        with bm.lock:
+            context.load_asset(path, token=True)
     except ValueError:
         tkinter.messagebox.showerror('Error', 'Failed to create token.')
 
@@ -81,12 +87,21 @@ def open_project():
     )
 
     if path:
-        context.load_project(path)
+        with bm.lock:
+            context.load_project(path)
         
 def new_project():
     prompt_save()
-    context.new_project()
-    bm.set_stage(context.project.active_stage)
+    with bm.lock:
+        context.new_project()
+        bm.set_stage(context.project.active_stage)
+
+def with_lock(func):
+    """return a function which calls func while holding the battlemap lock"""
+    def locked(*args, **kwargs):
+        with bm.lock:
+            return func(*args, **kwargs)
+    return locked
 
 class BattleMapContextMenu(tk.Menu):
     def __init__(self, master):
@@ -106,7 +121,9 @@ class BattleMapImageContextMenu(BattleMapContextMenu):
         self.insert_command(
             0,
             label="Delete",
-            command=lambda: context.project.active_stage.remove(self.target)
+            command=with_lock(
+                lambda: context.project.active_stage.remove(self.target)
+            )
         )
         self.insert_command(
             0,
@@ -116,14 +133,20 @@ class BattleMapImageContextMenu(BattleMapContextMenu):
         self.insert_command(
             0,
             label="Bring to front",
-            command=lambda: \
-                context.project.active_stage.bring_to_front(self.target)
+            command=with_lock(
+                lambda: context.project.active_stage.bring_to_front(
+                    self.target
+                )
+            )
         )
         self.insert_command(
             0,
             label="Send to back",
-            command=lambda: \
-                context.project.active_stage.send_to_back(self.target)
+            command=with_lock(
+                lambda: context.project.active_stage.send_to_back(
+                    self.target
+                )
+            )
         )
 
     def show_on_image(self, e, img):
@@ -135,7 +158,8 @@ class BattleMapImageContextMenu(BattleMapContextMenu):
             return
         
         try:
-            bm.snap_to_grid(self.target)
+            with bm.lock:
+                bm.snap_to_grid(self.target)
         except ValueError:
             tkinter.messagebox.showerror(
                 'Error',
@@ -143,8 +167,6 @@ class BattleMapImageContextMenu(BattleMapContextMenu):
             )
 
 class BattleMapLabel(tk.Frame):
-    FRAME_RATE_TARGET = 60
-    IDLE_FRAME_RATE = 10
     BORDER_THICKNESS = 10
 
     def __init__(self, master=None):
@@ -158,6 +180,7 @@ class BattleMapLabel(tk.Frame):
         bm.render()
 
         self.image = None
+        self.presenter = presenter.FramePresenter()
         self.create_image()
 
         self.background_menu = BattleMapContextMenu(self)
@@ -165,28 +188,34 @@ class BattleMapLabel(tk.Frame):
 
         self.bind_events()
 
-        self.rendering = True
         self.start_render_thread()
 
         self.pack(fill="both", expand=True)
 
     def create_image(self):
-        self.image = bm.get_photo_image()
-        self.label = tk.Label(self, image=self.image)
+        self.image = self.presenter.present(bm.image)
+        self.label = tk.Label(
+            self,
+            image=self.image,
+            bg=gui_util.get_hex_colour(gui_util.BG_COLOUR)
+        )
         self.label.pack(fill="both", expand=True)
 
     def show_context_menu(self, e):
-        img = bm.handle_mouse_down(e)
+        # the hit test needs to see the effects of any input still queued
+        with bm.lock:
+            bm.process_input()
+            img = bm.handle_mouse_down(e)
         if img is None:
             self.background_menu.show(e)
         else:
             self.image_menu.show_on_image(e, img)
 
     def bind_events(self):
-        self.label.bind('<Button>', bm.handle_mouse_down)
-        self.label.bind('<ButtonRelease>', bm.handle_mouse_up)
-        self.label.bind('<MouseWheel>', bm.handle_mouse_scroll)
-        self.label.bind('<Motion>', bm.handle_mouse_motion)
+        self.label.bind('<Button>', bm.input.on_button_down)
+        self.label.bind('<ButtonRelease>', bm.input.on_button_up)
+        self.label.bind('<MouseWheel>', bm.input.on_scroll)
+        self.label.bind('<Motion>', bm.input.on_motion)
         self.label.bind('<Button-3>', self.show_context_menu)
         root.bind('<Configure>', self.resize)
 
@@ -203,33 +232,36 @@ class BattleMapLabel(tk.Frame):
         h = e.height - 2 * BattleMapLabel.BORDER_THICKNESS
 
         self.label.configure(width=w, height=h)
-        bm.set_vp_size((w, h))
+        with bm.lock:
+            bm.set_vp_size((w, h))
         
     def destroy(self):
-        self.rendering = False
+        bm.scheduler.stop()
         super().destroy()
 
     def refresh_image(self):
-        prev_frame = time.time_ns()
-        frame_time_min = 1e9 / self.FRAME_RATE_TARGET # in ns, hence 1e9
-        frame_time_max = 1e9 / self.IDLE_FRAME_RATE
-
-        while self.rendering:
-            if bm.new_frame() or \
-                time.time_ns() > (prev_frame + frame_time_max):
-                
+        while bm.scheduler.wait():
+            if not bm.new_frame():
+                continue
+
+            profiling.profiler.start_frame()
+            with bm.lock:
+                bm.process_input()
                 bm.render()
+                cursor, bm.cursor = bm.cursor, None
 
-                _old_image = self.image # need to stop from being eaten by gc
-                self.image = bm.get_photo_image()
+            # tk calls wait on the ui thread, which may be waiting on the lock
+            if cursor is not None:
+                root.after(0, gui_util.set_cursor, cursor)
+
+            # the photo image is updated in place unless its size changed
+            photo = self.presenter.present(bm.image, bm.updated)
+            if photo is not self.image:
+                self.image = photo
                 self.label.configure(image=self.image)
-                
-                root.update_idletasks()
-                prev_frame = time.time_ns()
-            
-            delta_t = time.time_ns() - (prev_frame + frame_time_min) 
-            if delta_t > 0:
-                time.sleep(delta_t / 1e9)
+
+            root.update_idletasks()
+            profiling.profiler.end_frame()
 
     def start_render_thread(self):
         render_thread = threading.Thread(target=self.refresh_image)
@@ -1,13 +1,33 @@
+import collections
 import io
+import json
+import math
+import os
+import platform
+import sys
+import threading
+import time
+
 import numpy as np
 
 import PIL.Image, PIL.ImageTk
 
 import gui_util
+import profiling
+import util
 
-# must be either 'pillow' or 'pygame'; currently 'pygame' is somewhat faster
-# if using pillow, pillow-simd is likely to offer better performance
+# must be 'pillow', 'pygame' or 'numpy'; currently 'pygame' is somewhat faster
+# if using pillow, pillow-simd is likely to offer better performance. numpy
+# gives the same output on every machine, which suits headless use
 RENDERER = 'pygame' 
+RENDERERS = ['pygame', 'pillow', 'numpy']
+# the renderer can also be set with this environment variable or the
+# 'renderer' key of the config file, either of which may be 'auto' to use the
+# fastest renderer on this machine
+RENDERER_ENV_VAR = 'DNDMAP_RENDERER'
+AUTO_RENDERER = 'auto'
+# where the choice of renderer made by auto is kept
+RENDERER_CACHE_FILE = util.CACHE_DIR + 'renderer.json'
 
 class ImageWrapper():
     IMAGE_FORMAT = 'RGBA'
@@ -36,12 +56,59 @@ class ImageWrapper():
     def get_pillow_image(self):
         """return a PIL.Image with this image's data"""
 
+    def get_pillow_view(self, region=None):
+        """
+        return a PIL.Image of region (x, y, w, h) of this image, or all of it,
+        for display, copying as little as possible. The result may share
+        memory with this image, so should be discarded before it changes.
+        """
+        if region is None:
+            return self.get_pillow_image()
+        return self.crop(region).get_pillow_image()
+
     def get_imagetk(self):
         """return a PIL.ImageTk.PhotoImage for use in the tkinter UI"""
-        return PIL.ImageTk.PhotoImage(self.get_pillow_image())
+        with profiling.profiler.phase('pil_convert'):
+            pillow_image = self.get_pillow_image()
+        with profiling.profiler.phase('photo_image'):
+            return PIL.ImageTk.PhotoImage(pillow_image)
+
+    def blit(self, other, offset, area=None):
+        """
+        blit other image onto this one with top left at offset. If area is
+        provided, only the (x, y, w, h) region of other is blitted.
+        """
+
+    def blit_scaled(self, other, offset, size, area=None):
+        """
+        blit other, stretched to size, onto this image with top left at
+        offset, sampling the nearest pixels. If area is provided, only the
+        (x, y, w, h) region of the stretched image is drawn, and only the
+        part of other under it is scaled. Intended for cheap previews.
+        """
+
+    @staticmethod
+    def source_box(other, size, area):
+        """return the (x0, y0, x1, y1) region of other under area at size"""
+        x, y, w, h = area
+        scale_x = other.w / size[0]
+        scale_y = other.h / size[1]
+        return x * scale_x, y * scale_y, (x + w) * scale_x, (y + h) * scale_y
+
+    def paste(self, other, offset):
+        """
+        copy other onto this image with top left at offset, replacing the
+        pixels underneath rather than blending with them
+        """
+
+    def fill(self, colour, rect=None):
+        """fill rect of this image, or the whole image, with colour"""
+
+    def crop(self, rect):
+        """return the (x, y, w, h) region of this image as an image"""
 
-    def blit(self, other, offset):
-        """blit other image onto this one with top left at offset"""
+    def scroll(self, dx, dy):
+        """shift the contents of this image in place by dx, dy"""
 
     def draw_line(self, start, end, colour, width):
         """draw a line of width on this image from start to end in colour"""
@@ -88,26 +155,117 @@ class ImageWrapper():
         return Image.load(io.BytesIO(data))
 
 class PygameImage(ImageWrapper):
+    # PIL raw modes for the memory layout of 32 bit surfaces with the given
+    # (red, green, blue) masks, on little endian machines
+    RAW_MODES = {
+        (0xff0000, 0xff00, 0xff): 'BGRX',
+        (0xff, 0xff00, 0xff0000): 'RGBX'
+    }
+
+    # every surface is converted once to one of these layouts, which are
+    # SDL's native 32 bit formats, so that blits between them copy or blend
+    # pixels directly rather than converting them. Opaque images are XRGB;
+    # those with any clear pixels are ARGB, as smoothscale blends the
+    # colorkey into its neighbours so that it no longer matches.
+    OPAQUE_MASKS = (0xff0000, 0xff00, 0xff, 0)
+    ALPHA_MASKS = (0xff0000, 0xff00, 0xff, 0xff000000)
+
     def __init__(self, **kwargs):
+        """
+        image: an existing surface to wrap, which is assumed to be in a
+            canonical format already; use PygameImage.from_surface if not.
+        colorkey: whether pixels of the transparency colour are transparent.
+        alpha: if true, a new image has per pixel alpha rather than using the
+            colorkey.
+        """
+
         super().__init__(**kwargs)
 
         self.transparency_colour = gui_util.BG_COLOUR
+        # buffer reused by blit_scaled
+        self.scratch = None
         
         image = kwargs.get('image')
         bg_colour = kwargs.get('bg_colour')
         
-        if not image:
-            self.image = pygame.Surface(self.size)
+        if not image and kwargs.get('alpha', False):
+            self.image = pygame.Surface(
+                self.size,
+                pygame.SRCALPHA,
+                32,
+                PygameImage.ALPHA_MASKS
+            )
+
+            if bg_colour:
+                self.fill(bg_colour)
+        elif not image:
+            self.image = pygame.Surface(
+                self.size,
+                0,
+                32,
+                PygameImage.OPAQUE_MASKS
+            )
             self.image.set_colorkey(self.transparency_colour)
         
             if bg_colour:
-                if not bg_colour[3]:
-                    self.image.fill(self.transparency_colour)
-                else:
-                    self.image.fill(bg_colour)
+                self.fill(bg_colour)
         else:
             self.image = image
-            self.image.set_colorkey(self.transparency_colour)
+            if kwargs.get('colorkey', True):
+                self.image.set_colorkey(self.transparency_colour)
+
+    @property
+    def colorkeyed(self):
+        return self.image.get_colorkey() is not None
+
+    @staticmethod
+    def is_canonical(surface):
+        masks = tuple(surface.get_masks())
+        if surface.get_flags() & pygame.SRCALPHA:
+            return masks == PygameImage.ALPHA_MASKS
+        return masks == PygameImage.OPAQUE_MASKS
+
+    @staticmethod
+    def from_surface(surface):
+        """
+        wrap surface, first converting it to a canonical format if it isn't
+        in one. Surfaces with no clear pixels have no transparency at all.
+        """
+
+        size = surface.get_size()
+        if PygameImage.is_canonical(surface):
+            return PygameImage(
+                size=size,
+                image=surface,
+                colorkey=surface.get_colorkey() is not None
+            )
+
+        per_pixel = surface.get_flags() & pygame.SRCALPHA
+        transparent = surface.get_colorkey() is not None
+        if per_pixel:
+            alpha = pygame.surfarray.pixels_alpha(surface)
+            transparent = transparent or not alpha.all()
+            del alpha # unlocks the surface
+
+        if transparent:
+            converted = pygame.Surface(
+                size,
+                pygame.SRCALPHA,
+                32,
+                PygameImage.ALPHA_MASKS
+            )
+            # the new surface is clear, so this copies the pixels exactly,
+            # and a plain blit leaves pixels of the colorkey clear
+            converted.blit(
+                surface,
+                (0, 0),
+                special_flags=pygame.BLEND_RGBA_MAX if per_pixel else 0
+            )
+            return PygameImage(size=size, image=converted, colorkey=False)
+
+        converted = pygame.Surface(size, 0, 32, PygameImage.OPAQUE_MASKS)
+        converted.blit(surface, (0, 0))
+        return PygameImage(size=size, image=converted, colorkey=False)
 
     def get_pillow_image(self):
         return PIL.Image.frombytes(
@@ -116,16 +274,110 @@ class PygameImage(ImageWrapper):
             pygame.image.tostring(self.image, Image.IMAGE_FORMAT, False)
         )
 
-    def blit(self, other, offset):
+    def get_pillow_view(self, region=None):
+        surface = self.image if region is None else \
+            self.image.subsurface(region)
+
+        raw_mode = None
+        if surface.get_bitsize() == 32 and sys.byteorder == 'little':
+            masks = tuple(surface.get_masks()[:3])
+            raw_mode = PygameImage.RAW_MODES.get(masks)
+
+        # transparent pixels are shown in the transparency colour, which
+        # matches the background of the UI
+        if raw_mode is None:
+            return PIL.Image.frombytes(
+                'RGB',
+                surface.get_size(),
+                pygame.image.tostring(surface, 'RGB')
+            )
+
+        # if the layout matches, PIL uses the surface's memory directly,
+        # otherwise it unpacks the pixels in a single pass
+        return PIL.Image.frombuffer(
+            'RGBX' if raw_mode == 'RGBX' else 'RGB',
+            surface.get_size(),
+            surface.get_buffer(),
+            'raw',
+            raw_mode,
+            surface.get_pitch(),
+            1
+        )
+
+    def blit(self, other, offset, area=None):
+        self.image.blit(other.image, offset, area)
+
+    def blit_scaled(self, other, offset, size, area=None):
+        if area is None:
+            area = (0, 0, *size)
+        _x, _y, w, h = area
+        x0, y0, x1, y1 = ImageWrapper.source_box(other, size, area)
+        x0, y0 = int(x0), int(y0)
+        source = other.image.subsurface((
+            x0,
+            y0,
+            max(min(math.ceil(x1), other.w) - x0, 1),
+            max(min(math.ceil(y1), other.h) - y0, 1)
+        ))
+
+        # scale into a reused buffer rather than allocating a surface per blit
+        self.ensure_scratch((w, h), source)
+        scaled = self.scratch.subsurface((0, 0, w, h))
+        pygame.transform.scale(source, (w, h), scaled)
+
+        self.scratch.set_colorkey(other.image.get_colorkey())
+        self.image.blit(self.scratch, offset, (0, 0, w, h))
+
+    def ensure_scratch(self, size, like):
+        """ensure scratch is at least size and of the same format as like"""
+        w, h = size
+        if self.scratch is not None:
+            scratch_w, scratch_h = self.scratch.get_size()
+            if w <= scratch_w and h <= scratch_h and \
+                self.scratch.get_bitsize() == like.get_bitsize() and \
+                self.scratch.get_masks() == like.get_masks() and \
+                self.scratch.get_flags() & pygame.SRCALPHA == \
+                    like.get_flags() & pygame.SRCALPHA:
+                return
+            w, h = max(w, scratch_w), max(h, scratch_h)
+
+        self.scratch = pygame.Surface(
+            (w, h),
+            like.get_flags() & pygame.SRCALPHA,
+            like
+        )
+
+    def paste(self, other, offset):
+        colorkey = other.image.get_colorkey()
+        other.image.set_colorkey(None)
         self.image.blit(other.image, offset)
+        other.image.set_colorkey(colorkey)
+
+    def fill(self, colour, rect=None):
+        if not colour[3] and not self.image.get_flags() & pygame.SRCALPHA:
+            colour = self.transparency_colour
+        self.image.fill(colour, rect)
+
+    def crop(self, rect):
+        x, y, w, h = rect
+        return PygameImage(
+            size=(w, h),
+            image=self.image.subsurface(rect),
+            colorkey=self.colorkeyed
+        )
+
+    def scroll(self, dx, dy):
+        self.image.scroll(dx, dy)
 
     def draw_line(self, start, end, colour, width):
         pygame.draw.line(self.image, colour, start, end, width)
 
     def flip(self, flip_x, flip_y):
+        # transforms keep the format of their input, so needn't be converted
         return PygameImage(
             size=self.size,
-            image=pygame.transform.flip(self.image, flip_x, flip_y)
+            image=pygame.transform.flip(self.image, flip_x, flip_y),
+            colorkey=self.colorkeyed
         )
 
     def _resize(self, new_size, fast=False):
@@ -134,12 +386,15 @@ class PygameImage(ImageWrapper):
         else:
             new_img = pygame.transform.smoothscale(self.image, new_size)
 
-        return PygameImage(size=new_size, image=new_img)
+        return PygameImage(
+            size=new_size,
+            image=new_img,
+            colorkey=self.colorkeyed
+        )
 
     @staticmethod
     def load(filelike):
-        image = pygame.image.load(filelike)
-        return PygameImage(size=image.get_size(), image=image)
+        return PygameImage.from_surface(pygame.image.load(filelike))
     
 class PillowImage(ImageWrapper):
     def __init__(self, **kwargs):
@@ -165,8 +420,43 @@ class PillowImage(ImageWrapper):
         if self.draw is None:
             self.draw = PIL.ImageDraw.Draw(self.image)
 
-    def blit(self, other, offset):
-        self.image.paste(other.image, offset, other.image)
+    def blit(self, other, offset, area=None):
+        if area is None:
+            src = other.image
+        else:
+            x, y, w, h = area
+            src = other.image.crop((x, y, x + w, y + h))
+        self.image.paste(src, offset, src)
+
+    def blit_scaled(self, other, offset, size, area=None):
+        if area is None:
+            area = (0, 0, *size)
+        _x, _y, w, h = area
+        src = other.image.resize(
+            (w, h),
+            PIL.Image.NEAREST,
+            ImageWrapper.source_box(other, size, area)
+        )
+        self.image.paste(src, offset, src)
+
+    def paste(self, other, offset):
+        self.image.paste(other.image, offset)
+
+    def fill(self, colour, rect=None):
+        if rect is None:
+            rect = (0, 0, self.w, self.h)
+        x, y, w, h = rect
+        self.image.paste(colour, (x, y, x + w, y + h))
+
+    def crop(self, rect):
+        x, y, w, h = rect
+        return PillowImage(
+            size=(w, h),
+            image=self.image.crop((x, y, x + w, y + h))
+        )
+
+    def scroll(self, dx, dy):
+        self.image.paste(self.image.copy(), (dx, dy))
 
     def draw_line(self, start, end, colour, width):
         self.ensure_draw()
@@ -195,19 +485,523 @@ class PillowImage(ImageWrapper):
         image = PIL.Image.open(filelike).convert(Image.IMAGE_FORMAT)
         return PillowImage(size=image.size, image=image)
 
-if RENDERER == 'pygame':
-    import contextlib
-    with contextlib.redirect_stdout(None):
-        import pygame
-    Image = PygameImage
-elif RENDERER == 'pillow':
-    import PIL.ImageDraw
-    Image = PillowImage
-else:
-    if RENDERER == '':
+class NumpyImage(ImageWrapper):
+    """
+    An image stored as a numpy array of RGBA bytes with shape (h, w, 4).
+    Drawing is done with vectorised numpy operations, so the output is the
+    same on every machine, and the array can be handed to PIL and to the
+    grid detector without conversion.
+    """
+
+    # ITU-R 601-2 luma weights, in 16 bit fixed point, as used by PIL
+    LUMA_WEIGHTS = (19595, 38470, 7471)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        image = kwargs.get('image')
+        bg_colour = kwargs.get('bg_colour', 0)
+
+        if image is None:
+            self.image = np.zeros((self.h, self.w, 4), np.uint8)
+            if bg_colour:
+                self.image[:] = bg_colour
+        else:
+            self.image = image
+
+    def get_pillow_image(self):
+        return PIL.Image.fromarray(self.image, Image.IMAGE_FORMAT)
+
+    def get_pillow_view(self, region=None):
+        if region is None:
+            array = self.image
+        else:
+            x, y, w, h = region
+            array = self.image[y:y + h, x:x + w]
+
+        # rows of a region narrower than the image aren't contiguous
+        array = np.ascontiguousarray(array)
+        h, w, _ = array.shape
+        return PIL.Image.frombuffer(
+            Image.IMAGE_FORMAT,
+            (w, h),
+            array,
+            'raw',
+            Image.IMAGE_FORMAT,
+            0,
+            1
+        )
+
+    def clip(self, offset, size):
+        """
+        return the (x, y, w, h) part of this image covered by an image of
+        size placed at offset, and the offset of that part within the placed
+        image, or None, None if they don't overlap.
+        """
+
+        x, y = offset
+        w, h = size
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + w, self.w), min(y + h, self.h)
+        if right <= left or bottom <= top:
+            return None, None
+        return (left, top, right - left, bottom - top), (left - x, top - y)
+
+    @staticmethod
+    def composite(dst, src):
+        """draw src over dst, arrays of the same shape, in place"""
+
+        alpha = src[..., 3]
+        if alpha.min() == 255:
+            dst[:] = src
+            return
+        if alpha.max() == 0:
+            return
+
+        a = alpha[..., np.newaxis].astype(np.uint16)
+        inv = 255 - a
+        under = dst.astype(np.uint16)
+
+        dst[..., :3] = (src[..., :3] * a + under[..., :3] * inv + 127) // 255
+        dst[..., 3:] = a + (under[..., 3:] * inv + 127) // 255
+
+    def draw_array(self, src, offset, blend):
+        """draw an array of pixels onto this image with top left at offset"""
+        src_h, src_w, _ = src.shape
+        region, src_offset = self.clip(offset, (src_w, src_h))
+        if region is None:
+            return
+
+        x, y, w, h = region
+        src_x, src_y = src_offset
+        src = src[src_y:src_y + h, src_x:src_x + w]
+        dst = self.image[y:y + h, x:x + w]
+        if blend:
+            NumpyImage.composite(dst, src)
+        else:
+            dst[:] = src
+
+    def blit(self, other, offset, area=None):
+        src = other.image
+        if area is not None:
+            x, y, w, h = area
+            src = src[y:y + h, x:x + w]
+        self.draw_array(src, offset, True)
+
+    def blit_scaled(self, other, offset, size, area=None):
+        if area is None:
+            area = (0, 0, *size)
+        x, y, w, h = area
+
+        xs = (np.arange(x, x + w) + 0.5) * (other.w / size[0])
+        ys = (np.arange(y, y + h) + 0.5) * (other.h / size[1])
+        src = other.image[
+            np.minimum(ys.astype(np.intp), other.h - 1)[:, np.newaxis],
+            np.minimum(xs.astype(np.intp), other.w - 1)
+        ]
+        self.draw_array(src, offset, True)
+
+    def paste(self, other, offset):
+        self.draw_array(other.image, offset, False)
+
+    def fill(self, colour, rect=None):
+        if rect is None:
+            self.image[:] = colour
+            return
+
+        x, y, w, h = rect
+        region, _ = self.clip((x, y), (w, h))
+        if region is not None:
+            x, y, w, h = region
+            self.image[y:y + h, x:x + w] = colour
+
+    def crop(self, rect):
+        x, y, w, h = rect
+        return NumpyImage(size=(w, h), image=self.image[y:y + h, x:x + w])
+
+    def scroll(self, dx, dy):
+        h, w = self.h, self.w
+        # numpy copies via a temporary where the two slices overlap
+        self.image[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)] = \
+            self.image[max(-dy, 0):h - max(dy, 0), max(-dx, 0):w - max(dx, 0)]
+
+    def draw_line(self, start, end, colour, width):
+        (x0, y0), (x1, y1) = start, end
+
+        # lines along an axis, like grid lines, are filled directly, covering
+        # the same pixels as PIL would
+        if y0 == y1:
+            left = min(x0, x1)
+            self.fill(
+                colour,
+                (left, y0 - (width - 1) // 2, abs(x1 - x0) + 1, width)
+            )
+        elif x0 == x1:
+            top = min(y0, y1)
+            self.fill(
+                colour,
+                (x0 - (width - 1) // 2, top, width, abs(y1 - y0) + 1)
+            )
+        else:
+            img = self.get_pillow_image().copy()
+            PIL.ImageDraw.Draw(img).line([start, end], colour, width)
+            self.image[:] = np.asarray(img)
+
+    def flip(self, flip_x, flip_y):
+        return NumpyImage(
+            size=self.size,
+            image=np.ascontiguousarray(
+                self.image[::-1 if flip_y else 1, ::-1 if flip_x else 1]
+            )
+        )
+
+    @staticmethod
+    def sample_positions(src_length, dst_length):
+        """
+        return the two source indices either side of the centre of each
+        destination pixel, and the weight of the second
+        """
+
+        pos = (np.arange(dst_length) + 0.5) * (src_length / dst_length) - 0.5
+        pos = np.clip(pos, 0, src_length - 1)
+        first = np.floor(pos).astype(np.intp)
+        second = np.minimum(first + 1, src_length - 1)
+        return first, second, (pos - first).astype(np.float32)
+
+    def _resize(self, new_size, fast=False):
+        w, h = new_size
+        if w == 0 or h == 0:
+            return NumpyImage(size=new_size)
+
+        if fast:
+            xs = ((np.arange(w) + 0.5) * (self.w / w)).astype(np.intp)
+            ys = ((np.arange(h) + 0.5) * (self.h / h)).astype(np.intp)
+            return NumpyImage(
+                size=new_size,
+                image=self.image[ys[:, np.newaxis], xs]
+            )
+
+        # bilinear, on premultiplied colours so that the colour of clear
+        # pixels doesn't bleed into their neighbours
+        px = self.image.astype(np.float32)
+        px[..., :3] *= px[..., 3:] / 255
+
+        top, bottom, weight = NumpyImage.sample_positions(self.h, h)
+        px = px[top] + (px[bottom] - px[top]) * weight[:, None, None]
+        left, right, weight = NumpyImage.sample_positions(self.w, w)
+        px = px[:, left] + (px[:, right] - px[:, left]) * weight[None, :, None]
+
+        alpha = px[..., 3:]
+        px[..., :3] = np.divide(
+            px[..., :3] * 255,
+            alpha,
+            out=np.zeros_like(px[..., :3]),
+            where=alpha > 0
+        )
+
+        return NumpyImage(
+            size=new_size,
+            image=np.clip(np.rint(px), 0, 255).astype(np.uint8)
+        )
+
+    def as_greyscale_array(self):
+        r, g, b = NumpyImage.LUMA_WEIGHTS
+        px = self.image
+        return ((
+            px[..., 0] * np.uint32(r) + px[..., 1] * np.uint32(g) + \
+                px[..., 2] * np.uint32(b) + 0x8000
+        ) >> 16).astype(np.uint8)
+
+    @staticmethod
+    def load(filelike):
+        image = np.array(
+            PIL.Image.open(filelike).convert(Image.IMAGE_FORMAT)
+        )
+        return NumpyImage(size=(image.shape[1], image.shape[0]), image=image)
+
+class MipmapPyramid():
+    """
+    A chain of copies of an image, each half the size of the last, built as
+    they are needed. Scaling an image down can then start from the nearest
+    level rather than from the full size image.
+    """
+
+    # levels aren't built once they would be smaller than this
+    MIN_SIZE = 16
+
+    def __init__(self, image):
+        self.levels = [image]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def level_for(self, size):
+        """return the smallest level at least as large as size"""
+        w, h = size
+        i = 0
+        while True:
+            level = self.levels[i]
+            next_w, next_h = level.w // 2, level.h // 2
+            if next_w < max(w, MipmapPyramid.MIN_SIZE) or \
+                next_h < max(h, MipmapPyramid.MIN_SIZE):
+                return level
+
+            i += 1
+            if i == len(self.levels):
+                self.levels.append(level.resize((next_w, next_h)))
+
+class TransformCache():
+    """
+    A process-wide cache of transformed images, so that assets drawn with the
+    same transform share a single image. Entries are keyed by a tuple which
+    identifies the source and the transform, and the least recently used are
+    evicted once the images held exceed the memory budget.
+    """
+
+    DEFAULT_BUDGET = 256 * 1024 * 1024 # bytes
+    BYTES_PER_PIXEL = 4
+
+    def __init__(self, budget=None):
+        self.budget = TransformCache.DEFAULT_BUDGET if budget is None \
+            else budget
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def cost(image):
+        return image.w * image.h * TransformCache.BYTES_PER_PIXEL
+
+    def get(self, key, build):
+        """return the image cached under key, calling build() if absent"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        image = build()
+        cost = TransformCache.cost(image)
+
+        with self.lock:
+            if cost <= self.budget and key not in self.entries:
+                self.entries[key] = image
+                self.used += cost
+                self.evict()
+
+        return image
+
+    def evict(self):
+        while self.used > self.budget:
+            _key, image = self.entries.popitem(last=False)
+            self.used -= TransformCache.cost(image)
+            self.evictions += 1
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'used': self.used,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+transform_cache = TransformCache()
+
+# decoded tiles of tiled images; the scaled tiles go in transform_cache
+TILE_CACHE_BUDGET = 128 * 1024 * 1024 # bytes
+tile_cache = TransformCache(TILE_CACHE_BUDGET)
+
+def read_size(path):
+    """return the size of the image at path, without decoding it"""
+    with PIL.Image.open(path) as img:
+        return img.size
+
+def open_large(path):
+    """
+    decode the image at path with PIL. Very large images are expected here,
+    so the decompression bomb check doesn't apply.
+    """
+
+    limit = PIL.Image.MAX_IMAGE_PIXELS
+    PIL.Image.MAX_IMAGE_PIXELS = None
+    try:
+        img = PIL.Image.open(path)
+        img.load()
+    finally:
+        PIL.Image.MAX_IMAGE_PIXELS = limit
+    return img
+
+def split_into_tiles(path, tile_size):
+    """
+    decode the image at path and cut it into a pyramid of square tiles of
+    tile_size, each level half the size of the last, until one tile covers a
+    whole level. Returns the size of the image and a dict mapping (level,
+    col, row) to the tiles, encoded in BLOB_FORMAT.
+    """
+
+    level_image = open_large(path)
+    if level_image.mode not in ('RGB', 'RGBA'):
+        level_image = level_image.convert(Image.IMAGE_FORMAT)
+
+    size = level_image.size
+    tiles = {}
+    level = 0
+    while True:
+        w, h = level_image.size
+        for col in range(math.ceil(w / tile_size)):
+            for row in range(math.ceil(h / tile_size)):
+                x, y = col * tile_size, row * tile_size
+                blob = io.BytesIO()
+                level_image.crop(
+                    (x, y, min(x + tile_size, w), min(y + tile_size, h))
+                ).save(blob, format=Image.BLOB_FORMAT)
+                tiles[(level, col, row)] = blob.getvalue()
+
+        if w <= tile_size and h <= tile_size:
+            return size, tiles
+
+        level_image = level_image.reduce(2)
+        level += 1
+
+def load_renderer(name):
+    """import the renderer name and return its image class"""
+    global pygame
+
+    if name == 'pygame':
+        import contextlib
+        with contextlib.redirect_stdout(None):
+            import pygame
+        return PygameImage
+    elif name == 'pillow':
+        import PIL.ImageDraw
+        return PillowImage
+    elif name == 'numpy':
+        import PIL.ImageDraw
+        return NumpyImage
+    elif name == '':
         raise ValueError(
-            'No renderer set. RENDERER must be either ' + \
-            '"pygame" or "pillow"'
+            'No renderer set. RENDERER must be one of ' + \
+            '"pygame", "pillow" or "numpy"'
         )
-    else:
-        raise ValueError(f'Renderer "{RENDERER}" not available.')
+
+    raise ValueError(f'Renderer "{name}" not available.')
+
+def set_renderer(name):
+    """make name, one of 'pygame', 'pillow' or 'numpy', the renderer"""
+    global Image, RENDERER
+
+    Image = load_renderer(name)
+    RENDERER = name
+
+def benchmark_renderer(cls, repeats=3):
+    """return the best time in seconds for cls to blit, resize and flip"""
+
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (256, 256, 4), dtype=np.uint8)
+    blob = io.BytesIO()
+    PIL.Image.fromarray(pixels, 'RGBA').save(blob, format='PNG')
+
+    src = cls.load(io.BytesIO(blob.getvalue()))
+    dst = cls(size=(1024, 1024), bg_colour=gui_util.Colours.BLACK)
+
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for i in range(16):
+            dst.blit(src, (i * 48, i * 32))
+        src.resize((384, 384))
+        src.resize((160, 160))
+        src.resize((384, 384), True)
+        src.flip(True, False)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+def renderer_environment():
+    """describe the libraries renderers use, to key cached choices by"""
+    env = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': np.__version__,
+        'pillow': PIL.__version__
+    }
+    try:
+        load_renderer('pygame')
+        env['pygame'] = pygame.version.ver
+    except ImportError:
+        env['pygame'] = None
+    return env
+
+def pick_fastest_renderer():
+    """
+    return the name of the fastest renderer available here, benchmarking
+    them if this hasn't been done with the same libraries before
+    """
+
+    env = renderer_environment()
+    path = os.path.expanduser(RENDERER_CACHE_FILE)
+    try:
+        with open(path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('environment') == env and \
+            cached.get('renderer') in RENDERERS:
+            return cached['renderer']
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    timings = {}
+    for name in RENDERERS:
+        try:
+            # images look up the active renderer, so each must be made active
+            set_renderer(name)
+        except ImportError:
+            continue
+        timings[name] = benchmark_renderer(Image)
+    fastest = min(timings, key=timings.get)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({
+                'renderer': fastest,
+                'environment': env,
+                'timings': timings
+            }, f, indent=1)
+    except OSError:
+        pass
+
+    return fastest
+
+def configured_renderer():
+    """
+    return the renderer named by the environment variable, else the config
+    file, else RENDERER, resolving 'auto' to the fastest renderer
+    """
+
+    name = os.environ.get(RENDERER_ENV_VAR) or \
+        util.load_config().get('renderer') or RENDERER
+    if name == AUTO_RENDERER:
+        return pick_fastest_renderer()
+    return name
+
+set_renderer(configured_renderer())
@@ -0,0 +1,124 @@
+"""
+Mouse input is queued by the Tk thread and consumed by the render thread once
+per frame. Bursts of motion and scroll events are coalesced as they are
+queued, so that the work done per frame doesn't grow with the event rate.
+"""
+
+import enum
+import threading
+
+import gui_util
+
+class InputKind(enum.Enum):
+    MOTION = enum.auto()
+    SCROLL = enum.auto()
+    BUTTON_DOWN = enum.auto()
+    BUTTON_UP = enum.auto()
+
+class InputEvent():
+    """A mouse event, along with the modifier keys held when it occurred."""
+
+    def __init__(self, kind, **kwargs):
+        self.kind = kind
+        self.x = kwargs.get('x', 0)
+        self.y = kwargs.get('y', 0)
+        self.num = kwargs.get('num')
+        self.delta = kwargs.get('delta', 0)
+        self.ctrl = kwargs.get('ctrl', False)
+        self.shift = kwargs.get('shift', False)
+
+    def __repr__(self):
+        return f'<InputEvent {self.kind.name} at ({self.x}, {self.y})>'
+
+    @staticmethod
+    def from_tk(kind, e, **kwargs):
+        return InputEvent(
+            kind,
+            x=e.x,
+            y=e.y,
+            num=kwargs.get('num', e.num),
+            delta=kwargs.get('delta', 0),
+            ctrl=gui_util.get_ctrl_down(),
+            shift=gui_util.get_shift_down()
+        )
+
+class InputQueue():
+    """
+    Holds the input events received since the last frame. A motion event
+    replaces any earlier motion and scroll events are summed with earlier
+    scrolls made with the same modifiers, as long as no button was pressed or
+    released in between. Button events are always kept, in order.
+    """
+
+    SCROLL_DELTA_DEFAULT = 120
+    # x11 reports scrolling as presses of these buttons
+    SCROLL_BUTTONS = {4: -SCROLL_DELTA_DEFAULT, 5: SCROLL_DELTA_DEFAULT}
+
+    def __init__(self, listener=None):
+        self.events = []
+        # called whenever an event is queued
+        self.listener = listener
+        self.lock = threading.Lock()
+        # index in events after the last button event
+        self.barrier = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def pending(self):
+        return bool(self.events)
+
+    def push(self, event):
+        self.queue(event)
+        if self.listener is not None:
+            self.listener()
+
+    def queue(self, event):
+        with self.lock:
+            if event.kind in (InputKind.BUTTON_DOWN, InputKind.BUTTON_UP):
+                self.events.append(event)
+                self.barrier = len(self.events)
+                return
+
+            for i in range(self.barrier, len(self.events)):
+                queued = self.events[i]
+                if queued.kind != event.kind:
+                    continue
+
+                if event.kind == InputKind.MOTION:
+                    del self.events[i]
+                    break
+                if (queued.ctrl, queued.shift) == (event.ctrl, event.shift):
+                    queued.x, queued.y = event.x, event.y
+                    queued.delta += event.delta
+                    return
+            self.events.append(event)
+
+    def drain(self):
+        """remove and return the queued events, oldest first"""
+        with self.lock:
+            events = self.events
+            self.events = []
+            self.barrier = 0
+        return events
+
+    def on_motion(self, e):
+        self.push(InputEvent.from_tk(InputKind.MOTION, e))
+
+    def on_scroll(self, e):
+        self.push(InputEvent.from_tk(InputKind.SCROLL, e, delta=-e.delta))
+
+    def on_button_down(self, e):
+        if e.num in InputQueue.SCROLL_BUTTONS:
+            self.push(InputEvent.from_tk(
+                InputKind.SCROLL,
+                e,
+                delta=InputQueue.SCROLL_BUTTONS[e.num]
+            ))
+        else:
+            self.push(InputEvent.from_tk(InputKind.BUTTON_DOWN, e))
+
+    def on_button_up(self, e):
+        if e.num not in InputQueue.SCROLL_BUTTONS:
+            self.push(InputEvent.from_tk(InputKind.BUTTON_UP, e))
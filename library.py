@@ -112,14 +112,16 @@ class Project():
             asset_mapping = assets.AssetMapping()
 
             asset_list = [assets.build_from_db_tup(tup, lazy=True,
-                loader=db.load_asset) for tup in db.load_asset_list()] 
+                loader=db.load_asset, tile_loader=db.load_asset_tile) \
+                for tup in db.load_asset_list()] 
             for a in asset_list:
                 asset_mapping.add(a)
         
             kwargs['assets'] = asset_mapping
         else:
             kwargs['assets'] = assets.AssetMapping([assets.build_from_db_tup( \
-                tup) for tup in db.load_assets()])
+                tup, tile_loader=db.load_asset_tile) \
+                for tup in db.load_assets()])
 
         # For each stage asset, create a stage asset object with asset drawn
         # from the project asset library. Store these in a dict mapping index
@@ -162,10 +164,10 @@ class DataContext():
     persistence between sessions.
     """
 
-    CACHE_DIR = './cache/' if util.DEBUG else '~/.dndmap/cache/'
+    CACHE_DIR = util.CACHE_DIR
     ASSET_FORMATS = image.Image.FORMATS
     CACHE_FILE = CACHE_DIR + 'cache.json'
-    ARCHIVE_FILE = CACHE_DIR + 'archive.db'
+    ARCHIVE_FILE = util.ARCHIVE_FILE
 
     def __init__(self):
         self.archive = database.ArchiveDatabase(DataContext.ARCHIVE_FILE)
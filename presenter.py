@@ -0,0 +1,80 @@
+import PIL.ImageTk
+
+import profiling
+import rect
+
+class FramePresenter():
+    """
+    Shows frames in a single tkinter PhotoImage which is updated in place,
+    rather than creating a new PhotoImage each frame. Where the regions of a
+    frame which changed are known, only those are copied.
+    """
+
+    # if more than this fraction of the frame changed, copy all of it
+    FULL_UPDATE_RATIO = 0.5
+
+    def __init__(self):
+        self.photo = None
+        # photo image which changed regions are staged in before being copied
+        # into place, as PIL can only paste to the top left of a photo image
+        self.scratch = None
+
+    @property
+    def size(self):
+        if self.photo is None:
+            return 0, 0
+        return self.photo.width(), self.photo.height()
+
+    def present(self, frame, regions=None):
+        """
+        show frame, of which only regions have changed since the last frame,
+        or all of it if regions is None. Returns the PhotoImage showing the
+        frame, which is a new object only if the frame size has changed.
+        """
+
+        profiler = profiling.profiler
+
+        if self.photo is None or self.size != frame.size:
+            with profiler.phase('pil_convert'):
+                view = frame.get_pillow_view()
+            with profiler.phase('photo_image'):
+                self.photo = PIL.ImageTk.PhotoImage(view)
+                self.scratch = None
+            return self.photo
+
+        if regions is not None:
+            regions = [r for r in regions if not rect.empty(r)]
+            changed = sum(rect.area(r) for r in regions)
+            if changed > rect.area((0, 0, *frame.size)) * \
+                FramePresenter.FULL_UPDATE_RATIO:
+                regions = None
+
+        if regions is None:
+            with profiler.phase('pil_convert'):
+                view = frame.get_pillow_view()
+            with profiler.phase('photo_image'):
+                self.photo.paste(view)
+        else:
+            for r in regions:
+                self.paste_region(frame, r)
+
+        return self.photo
+
+    def paste_region(self, frame, region):
+        x, y, w, h = region
+
+        with profiling.profiler.phase('pil_convert'):
+            view = frame.get_pillow_view(region)
+
+        with profiling.profiler.phase('photo_image'):
+            if self.scratch is None:
+                self.scratch = PIL.ImageTk.PhotoImage(view.mode, frame.size)
+            self.scratch.paste(view)
+            self.photo.tk.call(
+                str(self.photo),
+                'copy',
+                str(self.scratch),
+                '-from', 0, 0, w, h,
+                '-to', x, y,
+                '-compositingrule', 'set'
+            )
@@ -0,0 +1,166 @@
+"""
+Optional per-frame timing of the render loop. Code marks out phases with
+
+    with profiling.profiler.phase('name'):
+        ...
+
+which costs next to nothing while profiling is disabled. When enabled, the
+time spent in each phase of each frame is kept for a rolling window of frames
+which can be summarised in-process or dumped to a json file.
+
+Set DNDMAP_PROFILE to a file path to enable profiling on startup and dump the
+summary to that path on exit.
+"""
+
+import atexit
+import collections
+import contextlib
+import json
+import math
+import os
+import time
+
+PROFILE_ENV_VAR = 'DNDMAP_PROFILE'
+
+def percentile(values, p):
+    """return the p-th percentile of values, by nearest rank"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+class NullProfiler():
+    """Stands in for a FrameProfiler while profiling is disabled."""
+
+    enabled = False
+
+    _null_phase = contextlib.nullcontext()
+
+    def start_frame(self):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def phase(self, _name):
+        return NullProfiler._null_phase
+
+    def record(self, _name, _seconds):
+        pass
+
+    def summary(self):
+        return {}
+
+    def dump(self, _path):
+        pass
+
+class FrameProfiler():
+    """Records the time spent in named phases of each frame."""
+
+    enabled = True
+
+    # number of recent frames which statistics are computed over
+    WINDOW = 1000
+    PERCENTILES = [50, 95, 99]
+    # frames taking longer than this many seconds count as dropped
+    DEFAULT_FRAME_BUDGET = 1 / 60
+
+    def __init__(self, **kwargs):
+        self.frame_budget = kwargs.get(
+            'frame_budget',
+            FrameProfiler.DEFAULT_FRAME_BUDGET
+        )
+        self.frames = collections.deque(
+            maxlen=kwargs.get('window', FrameProfiler.WINDOW)
+        )
+        self.frame_count = 0
+        self.dropped = 0
+
+        self.current = None
+        self.frame_start = None
+
+    def start_frame(self):
+        self.current = {}
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.current is None:
+            return
+
+        elapsed = time.perf_counter() - self.frame_start
+        self.current['frame'] = elapsed
+        self.frames.append(self.current)
+        self.frame_count += 1
+        if elapsed > self.frame_budget:
+            self.dropped += 1
+
+        self.current = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        """add seconds to the time spent in phase name this frame"""
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0) + seconds
+
+    def phase_times(self, name):
+        return [f[name] for f in self.frames if name in f]
+
+    def summary(self):
+        """return percentiles in milliseconds of each phase over the window"""
+        names = []
+        for f in self.frames:
+            names.extend(n for n in f if n not in names)
+
+        phases = {}
+        for name in names:
+            times = self.phase_times(name)
+            phases[name] = {
+                'count': len(times),
+                'mean_ms': sum(times) / len(times) * 1e3,
+                **{
+                    f'p{p}_ms': percentile(times, p) * 1e3
+                    for p in FrameProfiler.PERCENTILES
+                }
+            }
+
+        return {
+            'frames': self.frame_count,
+            'dropped': self.dropped,
+            'window': len(self.frames),
+            'frame_budget_ms': self.frame_budget * 1e3,
+            'phases': phases
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+profiler = NullProfiler()
+
+def enable(path=None, **kwargs):
+    """
+    start profiling frames; kwargs are passed to FrameProfiler. If path is
+    provided, the summary is written there when the program exits.
+    """
+
+    global profiler
+
+    profiler = FrameProfiler(**kwargs)
+    if path is not None:
+        atexit.register(profiler.dump, path)
+    return profiler
+
+def disable():
+    global profiler
+    profiler = NullProfiler()
+
+if os.environ.get(PROFILE_ENV_VAR):
+    enable(os.environ[PROFILE_ENV_VAR])
@@ -0,0 +1,79 @@
+"""Helpers for rectangles, stored as (x, y, w, h) tuples."""
+
+def empty(rect):
+    _x, _y, w, h = rect
+    return w <= 0 or h <= 0
+
+def area(rect):
+    _x, _y, w, h = rect
+    return max(w, 0) * max(h, 0)
+
+def intersect(a, b):
+    """return the overlap of rects a and b, or None if they don't overlap"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+
+    x = max(ax, bx)
+    y = max(ay, by)
+    w = min(ax + aw, bx + bw) - x
+    h = min(ay + ah, by + bh) - y
+
+    if w <= 0 or h <= 0:
+        return None
+    return x, y, w, h
+
+def union(a, b):
+    """return the smallest rect containing both a and b"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+
+    x = min(ax, bx)
+    y = min(ay, by)
+    return x, y, max(ax + aw, bx + bw) - x, max(ay + ah, by + bh) - y
+
+def offset(rect, dx, dy):
+    x, y, w, h = rect
+    return x + dx, y + dy, w, h
+
+def inflate(rect, margin):
+    x, y, w, h = rect
+    return x - margin, y - margin, w + 2 * margin, h + 2 * margin
+
+def contains_point(rect, px, py):
+    x, y, w, h = rect
+    return x <= px < x + w and y <= py < y + h
+
+def merge(rects, max_count):
+    """
+    merge overlapping rects in a list of rects, then keep merging the pair
+    which wastes the least area until at most max_count rects remain.
+    """
+
+    rects = [r for r in rects if not empty(r)]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                if intersect(rects[i], rects[j]):
+                    rects[i] = union(rects[i], rects[j])
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    while len(rects) > max_count:
+        best = None
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                u = union(rects[i], rects[j])
+                waste = area(u) - area(rects[i]) - area(rects[j])
+                if best is None or waste < best[0]:
+                    best = (waste, i, j, u)
+        _waste, i, j, u = best
+        rects[i] = u
+        del rects[j]
+
+    return rects
@@ -0,0 +1,80 @@
+import threading
+import time
+
+class FrameScheduler():
+    """
+    Decides when the render loop should produce a frame. Anything which
+    changes what is on screen calls request_frame; the render loop calls
+    wait, which blocks until a frame has been requested, no sooner than the
+    frame rate cap allows. In on demand mode nothing is rendered while there
+    are no requests, otherwise frames are produced continuously at the cap.
+    """
+
+    DEFAULT_FRAME_RATE = 60
+
+    def __init__(self, **kwargs):
+        # maximum frames per second, or None for no limit
+        self.frame_rate = kwargs.get(
+            'frame_rate',
+            FrameScheduler.DEFAULT_FRAME_RATE
+        )
+        self.on_demand = kwargs.get('on_demand', True)
+
+        self.condition = threading.Condition()
+        self.requested = True
+        self.running = True
+        self.last_frame = None
+
+    @property
+    def frame_interval(self):
+        if not self.frame_rate:
+            return 0
+        return 1 / self.frame_rate
+
+    def request_frame(self):
+        """note that the screen is out of date; safe from any thread"""
+        with self.condition:
+            self.requested = True
+            self.condition.notify_all()
+
+    def set_frame_rate(self, frame_rate):
+        with self.condition:
+            self.frame_rate = frame_rate
+            self.condition.notify_all()
+
+    def set_on_demand(self, on_demand):
+        with self.condition:
+            self.on_demand = on_demand
+            self.condition.notify_all()
+
+    def stop(self):
+        """wake the render loop, causing wait to return False"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def wait(self):
+        """
+        block until the next frame should be rendered. Returns True if it
+        should, or False if the scheduler has been stopped.
+        """
+
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.running or self.requested or \
+                    not self.on_demand
+            )
+
+            if self.last_frame is not None:
+                # requests made meanwhile are handled by this frame
+                self.condition.wait_for(
+                    lambda: not self.running,
+                    self.last_frame + self.frame_interval - time.perf_counter()
+                )
+
+            if not self.running:
+                return False
+
+            self.requested = False
+            self.last_frame = time.perf_counter()
+            return True
@@ -1,7 +1,10 @@
 import json
+import math
 
 import assets
 import gui_util
+import image
+import rect
 
 class PositionedAsset(assets.AssetWrapper):
     """A wrapper which holds another asset, and its position in a stage."""
@@ -28,6 +31,11 @@ class PositionedAsset(assets.AssetWrapper):
     def get_z(self):
         return self._z
 
+    # this gets overridden if the asset is put into a stage; it is called with
+    # the asset's previous bounds whenever it moves or changes appearance.
+    def on_change(self, old_bounds):
+        pass
+
     def get_dict(self):
         return super().get_dict().update({
             'x': self.x,
@@ -37,6 +45,8 @@ class PositionedAsset(assets.AssetWrapper):
 
 class StageAsset(PositionedAsset):
     GRAB_MARGIN = 10
+    # background assets are drawn into a cached layer beneath the tokens
+    BACKGROUND = True
     MIN_HEIGHT = 32
     MIN_WIDTH = 32
 
@@ -56,6 +66,11 @@ class StageAsset(PositionedAsset):
         self.pixel_pos = kwargs.get('pixel_pos', True)
 
         self.image = None
+        # flips which self.image was transformed with
+        self.image_flips = None
+        # while resizing, the asset is drawn as a stretched preview of image
+        self.resizing = False
+        self.preview_source = None
         self.apply_transform()
 
     def __str__(self):
@@ -89,6 +104,10 @@ class StageAsset(PositionedAsset):
     def size(self):
         return self.w, self.h
 
+    @property
+    def bounds(self):
+        return self.x, self.y, self.w, self.h
+
     @property
     def properties(self):
         return json.dumps(self.get_properties())
@@ -105,9 +124,17 @@ class StageAsset(PositionedAsset):
         return super().get_dict().update(self.get_properties())
 
     def set_size(self, w, h):
+        old_bounds = self.bounds
         self._w = w
         self._h = h
         self.apply_transform()
+        self.on_change(old_bounds)
+
+    def set_pos(self, x, y):
+        old_bounds = self.bounds
+        self._x += x - self.x
+        self._y += y - self.y
+        self.on_change(old_bounds)
 
     def finalise_dimensions(self):
         if self._w < 0:
@@ -124,26 +151,87 @@ class StageAsset(PositionedAsset):
         self._h = max(self._h, self.MIN_HEIGHT)
 
     def end_resize(self):
+        old_bounds = self.bounds
         self.finalise_dimensions()
+        self.resizing = False
+        self.preview_source = None
         self.apply_transform()
+        self.on_change(old_bounds)
+
+    @property
+    def flips(self):
+        return (self._w < 0) ^ self.flipped_x, (self._h < 0) ^ self.flipped_y
 
     def apply_transform(self, fast=False):
         _old_image = self.image
+        self.image = self.get_scaled_image(self.size, fast)
+        self.image_flips = self.flips
+
+    def get_preview_source(self):
+        """return image, flipped to match the current flips"""
+        if self.image_flips == self.flips:
+            return self.image
+
+        if self.preview_source is None or \
+            self.preview_source[0] != self.flips:
+            flip_x, flip_y = self.flips
+            old_x, old_y = self.image_flips
+            self.preview_source = (
+                self.flips,
+                self.image.flip(flip_x != old_x, flip_y != old_y)
+            )
+        return self.preview_source[1]
+
+    def get_scaled_image(self, size, fast=False):
+        """return this asset's image, flipped appropriately, at size"""
+        flip_x, flip_y = self.flips
+
+        # stage assets which share an asset and transform share the image too
+        return image.transform_cache.get(
+            (self.asset.uid, *size, flip_x, flip_y, fast),
+            lambda: self.transform(size, flip_x, flip_y, fast)
+        )
 
-        flip_x = (self._w < 0) ^ self.flipped_x
-        flip_y = (self._h < 0) ^ self.flipped_y
+    def transform(self, size, flip_x, flip_y, fast=False):
+        # start from the smallest copy of the image which is large enough
+        source = self.asset.mipmaps.level_for(size)
 
         if flip_x or flip_y:
-            self.image = self.base_image.flip(
-                flip_x, flip_y
-            ).resize((self.w, self.h), fast)
-        else:
-            self.image = self.base_image.resize((self.w, self.h), fast)
+            return source.flip(flip_x, flip_y).resize(size, fast)
+        return source.resize(size, fast)
+
+    def render_to(self, vp, x, y, area=None, size=None):
+        """
+        blit area of this asset's image onto vp at x, y. If size is provided,
+        the asset is drawn scaled to that size.
+        """
+
+        if size is None:
+            size = self.size
+        if size[0] <= 0 or size[1] <= 0:
+            return
 
-    def render_to(self, vp, x, y):
-        vp.blit(self.image, (x, y))
+        if self.resizing:
+            source = self.get_preview_source()
+            if source.size == size:
+                vp.blit(source, (x, y), area)
+            else:
+                vp.blit_scaled(source, (x, y), size, area)
+        elif size == self.size:
+            vp.blit(self.image, (x, y), area)
+        else:
+            vp.blit(self.get_scaled_image(size), (x, y), area)
 
     def handle_resize(self, drag_point, x, y):
+        """
+        move or resize this asset according to drag_point. Moving leaves the
+        image as is, while resizing draws a stretched preview of it until
+        end_resize applies the full transform.
+        """
+
+        old_bounds = self.bounds
+        old_shape = self._w, self._h
+
         if drag_point in [
             gui_util.DragPoints.TOP,
             gui_util.DragPoints.TOPLEFT,
@@ -177,7 +265,9 @@ class StageAsset(PositionedAsset):
             self._x = x - dx
             self._y = y - dy
 
-        self.apply_transform(True)
+        if (self._w, self._h) != old_shape:
+            self.resizing = True
+        self.on_change(old_bounds)
         
     def touching(self, x, y):
         in_range_y = -StageAsset.GRAB_MARGIN < y - self.y < \
@@ -219,6 +309,7 @@ class StageAsset(PositionedAsset):
 
 class TokenAsset(StageAsset):
     MIN_WIDTH = MIN_HEIGHT = 1
+    BACKGROUND = False
 
     def __init__(self, img, **kwargs):
         self.get_grid_info = kwargs.get(
@@ -261,8 +352,166 @@ class TokenAsset(StageAsset):
             'flipped_y': self.flipped_y
         })
 
+class TiledStageAsset(StageAsset):
+    """
+    A StageAsset of an assets.TiledImageAsset. Rather than holding a
+    transformed copy of the whole image, the tiles under the drawn area are
+    scaled from the nearest level of the tile pyramid as they are needed.
+    """
+
+    def apply_transform(self, fast=False):
+        # tiles are transformed as they are drawn
+        self.image_flips = self.flips
+
+    def get_scaled_tile(self, level, col, row, size, fast=False):
+        flip_x, flip_y = self.flips
+
+        def build():
+            tile = self.asset.get_tile(level, col, row)
+            if flip_x or flip_y:
+                tile = tile.flip(flip_x, flip_y)
+            return tile.resize(size, fast)
+
+        return image.transform_cache.get(
+            (self.asset.uid, level, col, row, *size, flip_x, flip_y, fast),
+            build
+        )
+
+    @staticmethod
+    def tile_spans(level_length, tile_size, length, flipped):
+        """
+        return (index, start, end) for each tile along an axis of a level
+        of level_length, when the level is scaled to length
+        """
+
+        scale = length / level_length
+        spans = []
+        for i in range(math.ceil(level_length / tile_size)):
+            start = math.floor(i * tile_size * scale)
+            end = math.floor(min((i + 1) * tile_size, level_length) * scale)
+            if flipped:
+                start, end = length - end, length - start
+            spans.append((i, start, end))
+        return spans
+
+    def render_to(self, vp, x, y, area=None, size=None):
+        if size is None:
+            size = self.size
+        w, h = size
+        if w <= 0 or h <= 0:
+            return
+        if area is None:
+            area = (0, 0, w, h)
+        area_x, area_y, area_w, area_h = area
+
+        level = self.asset.level_for(size)
+        level_w, level_h = self.asset.level_size(level)
+        flip_x, flip_y = self.flips
+        tile_size = self.asset.tile_size
+        spans = TiledStageAsset.tile_spans
+
+        cols = [
+            s for s in spans(level_w, tile_size, w, flip_x)
+            if s[1] < area_x + area_w and s[2] > area_x and s[2] > s[1]
+        ]
+        rows = [
+            s for s in spans(level_h, tile_size, h, flip_y)
+            if s[1] < area_y + area_h and s[2] > area_y and s[2] > s[1]
+        ]
+
+        for col, left, right in cols:
+            for row, top, bottom in rows:
+                tile_rect = (left, top, right - left, bottom - top)
+                clip_x, clip_y, clip_w, clip_h = \
+                    rect.intersect(tile_rect, area)
+                tile = self.get_scaled_tile(
+                    level,
+                    col,
+                    row,
+                    tile_rect[2:],
+                    self.resizing
+                )
+                vp.blit(
+                    tile,
+                    (x + clip_x - area_x, y + clip_y - area_y),
+                    (clip_x - left, clip_y - top, clip_w, clip_h)
+                )
+
+class TiledTokenAsset(TiledStageAsset, TokenAsset):
+    """A TokenAsset of an assets.TiledImageAsset, drawn from its tiles."""
+
+class SpatialIndex():
+    """
+    A uniform grid of square buckets, each holding the assets which overlap
+    it, so that the assets in a region can be found without checking all of
+    them.
+    """
+
+    BUCKET_SIZE = 256
+
+    def __init__(self, bucket_size=None):
+        self.bucket_size = bucket_size or SpatialIndex.BUCKET_SIZE
+        self.buckets = {}
+        # maps each asset to its bounds and the keys of buckets it is in
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def bucket_keys(self, region):
+        x, y, w, h = region
+        size = self.bucket_size
+        return [
+            (i, j)
+            for i in range(x // size, (x + max(w, 1) - 1) // size + 1)
+            for j in range(y // size, (y + max(h, 1) - 1) // size + 1)
+        ]
+
+    def insert(self, asset, bounds):
+        keys = self.bucket_keys(bounds)
+        for k in keys:
+            self.buckets.setdefault(k, set()).add(asset)
+        self.entries[asset] = (bounds, keys)
+
+    def remove(self, asset):
+        if asset not in self.entries:
+            return
+
+        _bounds, keys = self.entries.pop(asset)
+        for k in keys:
+            bucket = self.buckets[k]
+            bucket.discard(asset)
+            if not bucket:
+                del self.buckets[k]
+
+    def update(self, asset, bounds):
+        if asset in self.entries:
+            old_bounds, keys = self.entries[asset]
+            if old_bounds == bounds:
+                return
+            if keys == self.bucket_keys(bounds):
+                self.entries[asset] = (bounds, keys)
+                return
+
+        self.remove(asset)
+        self.insert(asset, bounds)
+
+    def query(self, region):
+        """return a set of the assets whose bounds overlap region"""
+        found = set()
+        for k in self.bucket_keys(region):
+            for asset in self.buckets.get(k, ()):
+                if asset not in found and \
+                    rect.intersect(self.entries[asset][0], region):
+                    found.add(asset)
+        return found
+
 def create_stage_asset(asset, **kwargs):
-    if kwargs.get('token'):
+    if asset.type == assets.AssetType.TILED_IMAGE:
+        if kwargs.get('token'):
+            return TiledTokenAsset(asset, **kwargs)
+        return TiledStageAsset(asset, **kwargs)
+    elif kwargs.get('token'):
         return TokenAsset(asset, **kwargs)
     else:
         return StageAsset(asset, **kwargs)
@@ -293,6 +542,16 @@ class Stage(assets.AssetLibrary):
         self.bg_colour = kwargs.get('bg_colour', Stage.DEFAULT_BG_COLOUR)
         self.notes = kwargs.get('notes', [])
 
+        # regions of the map, in map coordinates, which have changed since the
+        # last call to pop_damage, as (region, background) pairs where region
+        # None signifies that everything has changed and background is true
+        # if the background layer is affected
+        self.damage = []
+
+        self.index = SpatialIndex()
+        # maps assets to their position in self.assets; rebuilt on reorder
+        self._z_order = None
+
     @property
     def total_tile_size(self):
         return self.tile_size + self.line_width
@@ -306,14 +565,72 @@ class Stage(assets.AssetLibrary):
     def notes_json(self):
         return json.dumps(self.notes)
 
+    @property
+    def damaged(self):
+        return bool(self.damage)
+
+    def invalidate(self, region=None, background=True):
+        """
+        mark region (x, y, w, h) of the map as needing a redraw. If background
+        is false, only the token layer in that region has changed.
+        """
+        self.damage.append((region, background))
+        self.on_damage()
+
+    # this gets overridden when the stage is displayed, so that a frame can
+    # be scheduled whenever it is damaged.
+    def on_damage(self):
+        pass
+
+    def pop_damage(self):
+        """return the regions damaged since the last call, and clear them"""
+        damage, self.damage = self.damage, []
+        return damage
+
+    def asset_changed(self, asset, old_bounds):
+        self.index.update(asset, asset.bounds)
+        self.invalidate(old_bounds, asset.BACKGROUND)
+        self.invalidate(asset.bounds, asset.BACKGROUND)
+
+    def z_of(self, asset):
+        if self._z_order is None:
+            self._z_order = {a: i for i, a in enumerate(self.assets)}
+        return self._z_order.get(asset)
+
+    def draw_order(self, asset):
+        """sort key placing tokens above background assets, then by z"""
+        return not asset.BACKGROUND, self.z_of(asset)
+
+    def assets_in(self, region):
+        """return the assets overlapping region, from back to front"""
+        return sorted(self.index.query(region), key=self.draw_order)
+
+    def asset_at(self, x, y):
+        """
+        return the frontmost asset which can be grabbed at x, y along with the
+        point it would be grabbed by, or (DragPoints.NONE, None).
+        """
+
+        candidates = self.index.query(
+            rect.inflate((x, y, 1, 1), StageAsset.GRAB_MARGIN)
+        )
+        for asset in sorted(candidates, key=self.draw_order, reverse=True):
+            drag_point = asset.touching(x, y)
+            if drag_point != gui_util.DragPoints.NONE:
+                return drag_point, asset
+
+        return gui_util.DragPoints.NONE, None
+
     def add(self, asset):
-        if type(asset) == StageAsset:
+        if type(asset) in [StageAsset, TiledStageAsset]:
             new = asset
-        elif type(asset) == TokenAsset:
+        elif type(asset) in [TokenAsset, TiledTokenAsset]:
             new = asset
             new.get_grid_info = lambda: (self.total_tile_size, self.line_width)
         elif type(asset) == assets.ImageAsset:
             new = StageAsset(asset)
+        elif type(asset) == assets.TiledImageAsset:
+            new = TiledStageAsset(asset)
         else:
             raise ValueError(f'Can\'t add asset of type {type(asset)}')
 
@@ -322,8 +639,12 @@ class Stage(assets.AssetLibrary):
             scale_factor = max(new.w / map_w, new.h / map_h)
             new.set_size(int(new.w / scale_factor), int(new.h / scale_factor))
 
-        new.get_z = lambda: self.assets.index(new)
+        new.get_z = lambda: self.z_of(new)
+        new.on_change = lambda old_bounds: self.asset_changed(new, old_bounds)
         self.assets.append(new)
+        self._z_order = None
+        self.index.insert(new, new.bounds)
+        self.invalidate(new.bounds, new.BACKGROUND)
 
     def remove(self, asset):
         if asset is None:
@@ -332,6 +653,10 @@ class Stage(assets.AssetLibrary):
         try:
             self.assets.remove(asset)
             asset.get_z = lambda: None
+            asset.on_change = lambda old_bounds: None
+            self._z_order = None
+            self.index.remove(asset)
+            self.invalidate(asset.bounds, asset.BACKGROUND)
         except ValueError:
             pass
 
@@ -342,6 +667,8 @@ class Stage(assets.AssetLibrary):
         if asset in self.assets:
             self.assets.remove(asset)
         self.assets.append(asset)
+        self._z_order = None
+        self.invalidate(asset.bounds, asset.BACKGROUND)
 
     def send_to_back(self, asset):
         if asset is None:
@@ -350,6 +677,8 @@ class Stage(assets.AssetLibrary):
         if asset in self.assets:
             self.assets.remove(asset)
         self.assets.insert(0, asset)
+        self._z_order = None
+        self.invalidate(asset.bounds, asset.BACKGROUND)
 
     def add_many(self, stage_assets):
         for a in sorted(stage_assets, key=lambda a: a.z):
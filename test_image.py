@@ -0,0 +1,59 @@
+import io
+import os
+import unittest
+
+# must be set before pygame is imported so that no window is needed
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import PIL.Image
+
+import assets
+import battlemap
+import image
+import stage
+
+STAGE_COLOUR = (0, 0, 255, 255)
+TOKEN_COLOUR = (200, 40, 40, 255)
+# smoothscale rounds down, darkening scaled colours by a few levels
+COLOUR_TOLERANCE = 6
+
+def hard_edged_png(size, border):
+    """a png which is opaque within border pixels of its edge and clear"""
+    img = PIL.Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    img.paste(TOKEN_COLOUR, (border, border, size - border, size - border))
+    blob = io.BytesIO()
+    img.save(blob, format='PNG')
+    return blob.getvalue()
+
+class TestHardEdgedToken(unittest.TestCase):
+    def render_token(self):
+        s = stage.Stage(bg_colour=STAGE_COLOUR)
+        token = stage.TokenAsset(
+            assets.ImageAsset(
+                image=image.Image.from_bytes(hard_edged_png(100, 20))
+            ),
+            x=0,
+            y=0
+        )
+        s.add(token)
+        bm = battlemap.BattleMap(stage=s, vp_size=(400, 400), vp_pos=(0, 0))
+        bm.render()
+        return bm.image.get_pillow_image(), bm.to_frame_rect(token.bounds)
+
+    def test_clear_border_shows_stage(self):
+        frame, (x, y, w, h) = self.render_token()
+        self.assertNotEqual((w, h), (100, 100))
+        self.assertEqual(frame.getpixel((x + 1, y + 1))[:3], STAGE_COLOUR[:3])
+        self.assertEqual(
+            frame.getpixel((x + w - 2, y + h - 2))[:3],
+            STAGE_COLOUR[:3]
+        )
+
+    def test_opaque_centre_shows_token(self):
+        frame, (x, y, w, h) = self.render_token()
+        pixel = frame.getpixel((x + w // 2, y + h // 2))
+        for channel, expected in zip(pixel[:3], TOKEN_COLOUR[:3]):
+            self.assertAlmostEqual(channel, expected, delta=COLOUR_TOLERANCE)
+
+if __name__ == '__main__':
+    unittest.main()
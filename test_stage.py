@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+# must be set before pygame is imported so that no window is needed
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import PIL.Image
+
+import assets
+import battlemap
+import image
+import stage
+
+TOKEN_COLOUR = (200, 40, 40)
+# smoothscale rounds down, darkening scaled colours by a few levels
+COLOUR_TOLERANCE = 6
+
+def tiled_asset(size, tile_size):
+    """a TiledImageAsset of a single colour, cut into tiles of tile_size"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'token.png')
+        PIL.Image.new('RGB', size, TOKEN_COLOUR).save(path)
+        size, tiles = image.split_into_tiles(path, tile_size)
+
+    top = max(level for level, _col, _row in tiles)
+    return assets.TiledImageAsset(
+        image=image.Image.from_bytes(tiles[(top, 0, 0)]),
+        size=size,
+        tile_size=tile_size,
+        tiles=tiles
+    )
+
+class TestTiledToken(unittest.TestCase):
+    def test_create_keeps_token(self):
+        token = stage.create_stage_asset(
+            tiled_asset((300, 200), 64),
+            token=True
+        )
+        self.assertIsInstance(token, stage.TokenAsset)
+        self.assertIsInstance(token, stage.TiledStageAsset)
+        self.assertFalse(token.BACKGROUND)
+        self.assertTrue('"token": true' in token.properties)
+
+    def test_tiled_without_token(self):
+        piece = stage.create_stage_asset(tiled_asset((300, 200), 64))
+        self.assertNotIsInstance(piece, stage.TokenAsset)
+        self.assertTrue(piece.BACKGROUND)
+
+    def test_token_drawn_over_background(self):
+        s = stage.Stage(bg_colour=(0, 0, 255, 255))
+        s.add(stage.StageAsset(
+            assets.ImageAsset(
+                image=image.Image(size=(200, 200), bg_colour=(0, 255, 0, 255))
+            )
+        ))
+        token = stage.create_stage_asset(
+            tiled_asset((300, 300), 64),
+            token=True,
+            x=0,
+            y=0
+        )
+        s.add(token)
+        self.assertEqual(s.assets_in(token.bounds)[-1], token)
+
+        bm = battlemap.BattleMap(stage=s, vp_size=(400, 400), vp_pos=(0, 0))
+        bm.render()
+        x, y = bm.to_frame_rect(token.bounds)[:2]
+        pixel = bm.image.get_pillow_image().getpixel((x + 8, y + 8))
+        for channel, expected in zip(pixel[:3], TOKEN_COLOUR):
+            self.assertAlmostEqual(channel, expected, delta=COLOUR_TOLERANCE)
+
+if __name__ == '__main__':
+    unittest.main()
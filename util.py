@@ -1,7 +1,43 @@
+import hashlib
+import json
 import os
 
 DEBUG = True
 
+CACHE_DIR = './cache/' if DEBUG else '~/.dndmap/cache/'
+CONFIG_FILE = './config.json' if DEBUG else '~/.dndmap/config.json'
+ARCHIVE_FILE = CACHE_DIR + 'archive.db'
+
+# bytes of a file which are read at a time to digest it
+DIGEST_CHUNK_SIZE = 1 << 20
+
+def load_config():
+    """return the settings in CONFIG_FILE, or an empty dict if it is absent"""
+    try:
+        with open(os.path.expanduser(CONFIG_FILE), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def digest(data):
+    """
+    a digest of data which is the same in every process, unlike hash, as a
+    signed 64 bit integer so that sqlite can store it
+    """
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=8).digest(),
+        'little',
+        signed=True
+    )
+
+def file_digest(path):
+    """digest, as by digest, of the contents of the file at path"""
+    hasher = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return int.from_bytes(hasher.digest(), 'little', signed=True)
+
 def asset_name_from_path(path):
     name, _ = os.path.splitext(os.path.basename(path))
     return name